@@ -0,0 +1,6 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, print_function
+
+# NOTE This is a stub file to allow running benchmarks as modules, e.g. python -m benchmarks.variables
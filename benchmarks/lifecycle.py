@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the degoss module lifecycle, from installing Goss to cleaning up and pretty-printing the result, against
+a local stand-in for GitHub and a stand-in for Goss which reports a configurable number of checks.
+"""
+
+from __future__ import absolute_import, print_function
+
+from callback_plugins.degoss_format import CallbackModule
+from library.degoss import Degoss
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2 cannot trace allocations, so peaks are not measured there
+    tracemalloc = None
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+VERSION = '0.3.6'
+
+# the most precise clock available
+clock = getattr(time, 'perf_counter', time.time)
+
+# the module phases to report, as named in its timings
+PHASES = ('install', 'install.version', 'install.download', 'install.verify', 'test.variables', 'test.goss',
+    'test.parse', 'test.write', 'clean')
+
+# a stand-in for goss which reports the requested number of checks, one in a hundred failing, like goss validate does
+GENERATOR_SCRIPT = """
+import json, os, sys
+sys.stdin.read()
+checks = int(os.environ['DEGOSS_BENCHMARK_CHECKS'])
+results = []
+for i in range(checks):
+    successful = i % 100 != 1
+    results.append({
+        'duration': 1000, 'err': None, 'expected': ['true'], 'found': ['true' if successful else 'false'],
+        'human': '' if successful else 'Expected\\n    <bool>: false\\nto equal\\n    <bool>: true',
+        'meta': None, 'property': 'exists', 'resource-id': '/srv/file-{}'.format(i), 'resource-type': 'File',
+        'result': 0 if successful else 1, 'skipped': False, 'successful': successful,
+        'summary-line': 'File: /srv/file-{}: exists: {}'.format(i, 'matches expectation: [true]' if successful else
+            'Expected\\n    <bool>: false\\nto equal\\n    <bool>: true'),
+        'test-type': 0, 'title': '',
+    })
+summary = {'failed-count': len([r for r in results if not r['successful']]), 'test-count': checks,
+    'total-duration': checks * 1000}
+summary['summary-line'] = 'Count: {}, Failed: {}, Duration: 0.001s'.format(checks, summary['failed-count'])
+sys.stdout.write(json.dumps({'results': results, 'summary': summary}))
+"""
+
+
+class StubModule(object):
+    """A stand-in for AnsibleModule carrying parameters and capturing the result instead of exiting."""
+
+    def __init__(self, **params):
+        self.params, self.result = params, None
+
+    def exit_json(self, **result):
+        self.result = result
+
+
+class StubDisplay(object):
+    """A stand-in for Ansible's display which discards output."""
+
+    verbosity = 0
+
+    def display(self, message, color=None):
+        pass
+
+
+class StubTaskResult(object):
+    """A stand-in for an Ansible task result of the degoss module."""
+
+    class Host(object):
+
+        def get_name(self):
+            return 'benchmark'
+
+    class Task(object):
+        action = 'degoss'
+
+    def __init__(self, result):
+        self._host, self._task, self._result = self.Host(), self.Task(), result
+
+
+def create_release_server(binary):
+    """Serve the latest release redirect, the binary, and its checksum like GitHub does, returning the base URL."""
+    checksum = hashlib.sha256(binary).hexdigest()
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.endswith('/releases/latest'):
+                self.send_response(302)
+                self.send_header('Location', '/releases/tag/v{}'.format(VERSION))
+                self.end_headers()
+                return
+
+            body = b''
+
+            if '/releases/download/' in self.path:
+                body = (checksum + '\n').encode('utf-8') if self.path.endswith('.sha256') else binary
+
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server, "http://127.0.0.1:{}".format(server.server_address[1])
+
+
+def create_fixture(directory, binary_size):
+    """Create a test file and a stand-in for the Goss binary, padded to the size of a real one."""
+    test_dir = os.path.join(directory, 'tests')
+    os.makedirs(test_dir)
+
+    with open(os.path.join(test_dir, 'goss.yml'), 'w') as f:
+        f.write("file: {}\n")
+
+    generator = os.path.join(directory, 'generator.py')
+
+    with open(generator, 'w') as f:
+        f.write(GENERATOR_SCRIPT)
+
+    # the shell replaces itself with the generator before it reads the padding
+    script = "#!/bin/sh\nexec '{}' '{}' \"$@\"\n".format(sys.executable, generator).encode('utf-8')
+    padding = max(0, binary_size - len(script))
+    line = b'#' * 1023 + b'\n'
+
+    return test_dir, script + line * (padding // len(line)) + b'#' * (padding % len(line))
+
+
+def generate_facts(count):
+    """Generate a fact set with the given number of facts."""
+    return dict(('fact_{}'.format(i), {'value': 'x' * 32, 'index': i}) for i in range(count))
+
+
+def run_module(base_url, directory, test_dir, facts, stream_results):
+    """Execute the module end to end and return it with the captured result."""
+    module = StubModule(base_workdir=directory, clean=True, facts=facts, repo_url=base_url,
+        stream_results=stream_results, test_dir=test_dir, test_file=['goss.yml'], variables={'custom': 'value'},
+        verify_checksum=True, version='latest')
+
+    Degoss(sys.argv, module).execute()
+
+    return module
+
+
+def pretty_print(result):
+    """Pretty-print a module result as the callback does for each host."""
+    CallbackModule(display=StubDisplay()).pretty_print(StubTaskResult(result))
+
+
+def median(values):
+    """Return the median of the values."""
+    return sorted(values)[len(values) // 2]
+
+
+def measure(base_url, directory, test_dir, facts, checks, stream_results, repeat):
+    """Time each phase over the repetitions, then measure the peak memory use of one more run under tracemalloc."""
+    os.environ['DEGOSS_BENCHMARK_CHECKS'] = str(checks)
+
+    timings, printing = dict((phase, []) for phase in PHASES), []
+
+    for _ in range(repeat):
+        module = run_module(base_url, directory, test_dir, facts, stream_results)
+
+        if module.result.get('module_failed'):
+            raise RuntimeError("degoss failed: {}".format(module.result.get('msg')))
+
+        for phase in PHASES:
+            timings[phase].append(module.result['timings'].get(phase, 0.0))
+
+        started = clock()
+        pretty_print(module.result)
+        printing.append(clock() - started)
+
+    seconds = dict((phase, median(values)) for phase, values in timings.items())
+    seconds['pretty_print'] = median(printing)
+
+    if not tracemalloc:
+        return {'checks': checks, 'peak_bytes': None, 'seconds': seconds, 'stream_results': stream_results}
+
+    # tracing slows down allocations, so memory is measured separately from time
+    tracemalloc.start()
+    module = run_module(base_url, directory, test_dir, facts, stream_results)
+    execute_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    pretty_print(module.result)
+    print_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'checks': checks,
+        'peak_bytes': {'execute': execute_peak, 'pretty_print': print_peak},
+        'seconds': seconds,
+        'stream_results': stream_results,
+    }
+
+
+def format_result(result):
+    """Format a scenario's result as a single line."""
+    parts = ["checks={:<7} stream={:<5}".format(result['checks'], str(result['stream_results']).lower())]
+    parts.extend("{}={:.4f}s".format(phase, result['seconds'][phase]) for phase in PHASES + ('pretty_print',))
+
+    if result['peak_bytes']:
+        parts.extend("peak.{}={}KiB".format(name, size // 1024) for name, size in sorted(result['peak_bytes'].items()))
+
+    return " ".join(parts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--checks', default='10,100,1000,10000,100000',
+        help="Comma-separated numbers of checks for the Goss stand-in to report.")
+    parser.add_argument('--facts', type=int, default=500, help="Number of facts passed to Goss.")
+    parser.add_argument('--binary-size', type=int, default=10 * 1024 * 1024,
+        help="Size in bytes of the downloaded Goss stand-in.")
+    parser.add_argument('--repeat', type=int, default=3,
+        help="Number of timed runs per scenario, the median is reported.")
+    parser.add_argument('--output', help="Write results as JSON to this file in addition to standard output.")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    results = []
+
+    try:
+        test_dir, binary = create_fixture(directory, args.binary_size)
+        server, base_url = create_release_server(binary)
+        facts = generate_facts(args.facts)
+
+        try:
+            for checks in (int(value) for value in args.checks.split(',')):
+                for stream_results in (False, True):
+                    result = measure(base_url, directory, test_dir, facts, checks, stream_results, args.repeat)
+                    results.append(result)
+
+                    print(format_result(result))
+        finally:
+            server.shutdown()
+            server.server_close()
+    finally:
+        shutil.rmtree(directory)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark of degoss module startup, importing the module and executing it end to end, with cold and warm caches."""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# a stand-in for goss which passes a single test, so that the time measured is the module's own
+GOSS_SCRIPT = """#!{}
+import sys
+sys.stdin.read()
+sys.stdout.write('{{"results": [], "summary": {{"failed-count": 0, "test-count": 1}}}}')
+"""
+
+
+def create_fixture(directory):
+    """Create a Goss stand-in, a test file, and module arguments for a run on a pinned version and a local binary."""
+    test_dir = os.path.join(directory, 'tests')
+    os.makedirs(test_dir)
+
+    with open(os.path.join(test_dir, 'goss.yml'), 'w') as f:
+        f.write("file: {}\n")
+
+    binary_path = os.path.join(directory, 'goss')
+
+    with open(binary_path, 'w') as f:
+        f.write(GOSS_SCRIPT.format(sys.executable))
+
+    os.chmod(binary_path, 0o700)
+
+    args_file = os.path.join(directory, 'args.json')
+
+    with open(args_file, 'w') as f:
+        json.dump({'ANSIBLE_MODULE_ARGS': {'base_workdir': directory, 'binary_path': binary_path, 'facts': {},
+            'test_dir': test_dir, 'test_file': ['goss.yml'], 'variables': {}, 'version': '0.3.6'}}, f)
+
+    return args_file
+
+
+def run(command, cache_dir):
+    """Run a command in a new interpreter which keeps its bytecode in the given directory, returning the seconds taken."""
+    env = dict(os.environ, PYTHONPATH=ROOT, PYTHONPYCACHEPREFIX=cache_dir)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+
+    started = time.time()
+    subprocess.check_call(command, cwd=ROOT, env=env, stdout=open(os.devnull, 'w'))
+
+    return time.time() - started
+
+
+def measure(command, repeat, cold):
+    """Time the command, with an empty bytecode cache for every run when cold, otherwise with a primed one."""
+    timings, shared = [], tempfile.mkdtemp()
+
+    try:
+        if not cold:
+            run(command, shared)
+
+        for _ in range(repeat):
+            cache_dir = tempfile.mkdtemp() if cold else shared
+
+            try:
+                timings.append(run(command, cache_dir))
+            finally:
+                if cold:
+                    shutil.rmtree(cache_dir)
+    finally:
+        shutil.rmtree(shared)
+
+    timings.sort()
+
+    return {'min': timings[0], 'median': timings[len(timings) // 2], 'max': timings[-1]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=10, help="Number of timed runs per scenario.")
+    parser.add_argument('--output', help="Write results as JSON to this file in addition to standard output.")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    results = []
+
+    try:
+        args_file = create_fixture(directory)
+
+        scenarios = (
+            ('interpreter', [sys.executable, '-c', 'pass']),
+            ('import', [sys.executable, '-c', 'import library.degoss']),
+            ('execute', [sys.executable, os.path.join(ROOT, 'library', 'degoss.py'), args_file]),
+        )
+
+        for name, command in scenarios:
+            for cold in (True, False):
+                seconds = measure(command, args.repeat, cold)
+                cache = 'cold' if cold else 'warm'
+
+                results.append({'benchmark': name, 'cache': cache, 'seconds': seconds})
+                print("{:<12} {:<5} min {:.4f}s, median {:.4f}s, max {:.4f}s".format(name, cache, seconds['min'],
+                    seconds['median'], seconds['max']))
+    finally:
+        shutil.rmtree(directory)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Micro-benchmark of preparing Ansible facts and variables for Goss, for realistic and very large fact sets."""
+
+from __future__ import absolute_import, print_function
+
+from library.degoss import Degoss
+
+import argparse
+import io
+import json
+import sys
+import timeit
+
+
+class StubModule(object):
+    """A stand-in for AnsibleModule carrying only parameters."""
+
+    def __init__(self, **params):
+        self.params = params
+
+
+class DiscardingStream(io.RawIOBase):
+    """A writable binary stream which counts and discards what is written to it, standing in for Goss's stdin."""
+
+    def __init__(self):
+        super(DiscardingStream, self).__init__()
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+
+def generate_facts(mounts):
+    """Generate a fact set shaped like ansible_facts, scaled by the number of mounts and interfaces."""
+    return {
+        'hostname': 'dingo',
+        'distribution': 'Ubuntu',
+        'env': dict(('VARIABLE_{}'.format(i), 'value') for i in range(50)),
+        'interfaces': ['eth{}'.format(i) for i in range(mounts)],
+        'mounts': [
+            {'device': '/dev/sd{}'.format(i), 'fstype': 'ext4', 'mount': '/mnt/{}'.format(i), 'options': 'rw',
+                'size_available': 1024 * i, 'size_total': 4096 * i, 'uuid': '{:032x}'.format(i)}
+            for i in range(mounts)
+        ],
+        'packages': dict(('package-{}'.format(i), [{'version': '1.0.{}'.format(i), 'arch': 'amd64'}])
+            for i in range(mounts * 10)),
+    }
+
+
+def new_service(facts, stream_variables):
+    """Create a Degoss service ready to prepare variables."""
+    service = Degoss(sys.argv, StubModule(test_file='goss.yml', tmp_root='/tmp/degoss.benchmark',
+        test_dir='/tmp/degoss.benchmark/tests', stream_variables=stream_variables))
+    service.facts, service.variables = facts, {'custom': 'value'}
+
+    return service
+
+
+def prepare(facts):
+    """Merge variables and serialize them once, as when sharing one payload across test files."""
+    service = new_service(facts, False)
+
+    return len(json.dumps(dict(service.iter_variables())).encode('utf-8'))
+
+
+def stream(facts):
+    """Encode variables incrementally to a stream, as with stream_variables."""
+    service = new_service(facts, True)
+    sink = DiscardingStream()
+    service.write_variables(sink)
+
+    return sink.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5, help="Number of timed repetitions, the best is reported.")
+    parser.add_argument('--output', help="Write results as JSON to this file in addition to standard output.")
+    args = parser.parse_args()
+
+    results = []
+
+    for mounts in (10, 100, 1000):
+        facts = generate_facts(mounts)
+
+        for name, function in (('prepare', prepare), ('stream', stream)):
+            size = function(facts)
+            seconds = min(timeit.repeat(lambda: function(facts), number=1, repeat=args.repeat))
+
+            results.append({'benchmark': name, 'mounts': mounts, 'bytes': size, 'seconds': seconds})
+            print("{:<8} mounts={:<5} bytes={:<10} {:.6f}s".format(name, mounts, size, seconds))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,8 +6,110 @@ from __future__ import absolute_import, print_function
 from ansible import constants as C
 from ansible.plugins.callback import CallbackBase
 
+from collections import namedtuple
+from xml.sax.saxutils import escape, quoteattr
+
+import csv
 import json
+import math
 import os
+import re
+
+
+DOCUMENTATION = """
+---
+name: degoss_format
+type: aggregate
+short_description: Formats degoss results and summarizes them across hosts.
+description:
+    - Pretty-prints the result of each degoss run and, at the end of the playbook, a performance and failure summary
+      across all hosts.
+options:
+    deltas_only:
+        description: >
+            If true, print only the checks which newly failed or newly passed since the previous run for hosts which
+            diff against a baseline.
+        type: bool
+        default: false
+        env:
+            - name: DEGOSS_DELTAS_ONLY
+        ini:
+            - section: callback_degoss_format
+              key: deltas_only
+    summary_file:
+        description: If set, write the end of playbook summary to this file, as CSV if it ends in .csv, else as JSON.
+        default: null
+        env:
+            - name: DEGOSS_SUMMARY_FILE
+        ini:
+            - section: callback_degoss_format
+              key: summary_file
+    junit_file:
+        description: If set, write a JUnit XML report to this file, one test suite per host, as results arrive.
+        default: null
+        env:
+            - name: DEGOSS_JUNIT_FILE
+        ini:
+            - section: callback_degoss_format
+              key: junit_file
+    ndjson_file:
+        description: If set, write each host's result to this file as a line of JSON as results arrive.
+        default: null
+        env:
+            - name: DEGOSS_NDJSON_FILE
+        ini:
+            - section: callback_degoss_format
+              key: ndjson_file
+    rollup:
+        description: If true, print only test counts per host and each distinct failure once, with its hosts, at the end.
+        type: bool
+        default: false
+        env:
+            - name: DEGOSS_ROLLUP
+        ini:
+            - section: callback_degoss_format
+              key: rollup
+"""
+
+# characters which may not appear in XML documents
+INVALID_XML_MATCHER = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+IPV4_MATCHER = re.compile(r'\b\d{1,3}(?:\.\d{1,3}){3}\b')
+# how many hosts to list for each rolled up failure
+ROLLUP_HOST_LIMIT = 20
+# how many of the slowest hosts and most common failures to show in the summary
+SUMMARY_LIMIT = 10
+
+HostStats = namedtuple('HostStats', [
+    'host', 'module_failed', 'tests_total', 'tests_failed', 'tests_skipped', 'goss_seconds', 'download_seconds',
+    'download_bytes',
+])
+
+
+def normalize_failure(message, host):
+    """Replace host-specific values in a failure message so that identical failures across hosts compare equal."""
+    for name in sorted(set([host, host.split('.')[0]]), key=len, reverse=True):
+        message = re.sub(r'(?<![\w.-]){}(?![\w-])'.format(re.escape(name)), '<host>', message)
+
+    return IPV4_MATCHER.sub('<ip>', message)
+
+
+def xml_text(value):
+    """Escape a value for use as XML character data."""
+    return escape(INVALID_XML_MATCHER.sub('', u'{}'.format(value)))
+
+
+def xml_attr(value):
+    """Escape and quote a value for use as an XML attribute."""
+    return quoteattr(INVALID_XML_MATCHER.sub('', u'{}'.format(value)))
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of the sorted values, or None if there are none."""
+    if not values:
+        return None
+
+    return values[max(0, int(math.ceil(percent / 100.0 * len(values))) - 1)]
+
 
 class CallbackModule(CallbackBase):
 
@@ -15,6 +117,24 @@ class CallbackModule(CallbackBase):
     CALLBACK_NAME = 'degoss_format'
     CALLBACK_NEEDS_WHITELIST = False
 
+    def __init__(self, *args, **kwargs):
+        super(CallbackModule, self).__init__(*args, **kwargs)
+
+        self.host_stats, self.summary_file, self.rollup, self.deltas_only = [], None, False, False
+        self.junit_file, self.ndjson_file, self.junit, self.ndjson = None, None, None, None
+
+        # normalized failure message -> hosts with the failure
+        self.failures = {}
+
+    def set_options(self, *args, **kwargs):
+        super(CallbackModule, self).set_options(*args, **kwargs)
+
+        self.summary_file = self.get_option('summary_file')
+        self.rollup = self.get_option('rollup')
+        self.deltas_only = self.get_option('deltas_only')
+        self.junit_file = self.get_option('junit_file')
+        self.ndjson_file = self.get_option('ndjson_file')
+
     def pretty_print(self, task_result):
         """Pretty-print output for a Goss run."""
 
@@ -34,17 +154,37 @@ class CallbackModule(CallbackBase):
 
         if module_failed:
             # the module failed, so append the output of the Goss execution
-            output += os.linesep + os.linesep.join(map(lambda l: (' ' * 2) + l, result.get('stdout_lines')))
+            # not every module failure comes from Goss, those only return the module's log output
+            lines = result.get('stdout_lines') or result.get('output_lines') or []
+            output += os.linesep + os.linesep.join(map(lambda l: (' ' * 2) + l, lines))
+
+        if not module_failed and self.deltas_only and result.get('newly_failed') is not None:
+            # only what changed since the previous run, the unchanged failures are known already
+            output += (os.linesep * 2) + "({} newly failed, {} newly passed, {} unchanged)".format(
+                len(result.get('newly_failed')), len(result.get('newly_passed') or []), result.get('unchanged_count'))
 
-        if tests_failed:
+            for label, key in (("Newly failed", 'newly_failed'), ("Newly passed", 'newly_passed')):
+                if result.get(key):
+                    output += (os.linesep * 2) + label + ":" + os.linesep + (os.linesep * 2).join(result.get(key))
+        elif tests_failed and self.rollup:
+            # identical failures are printed once for all hosts at the end of the playbook
+            output += (os.linesep * 2) + "({} failure(s) rolled up into the summary)".format(
+                len(result.get('failures') or []))
+        elif tests_failed and not result.get('failures'):
+            # the module was asked to only return the summary, so the failures are only on the host
+            output += (os.linesep * 2) + "({} failure(s) not returned, see {} on the host)".format(
+                result.get('tests_failed'), result.get('result_file') or "the result file")
+        elif tests_failed:
             # goss module execution succeeded, but tests failed
             output += (os.linesep * 2) + (os.linesep * 2).join(result.get('failures'))
 
         if not module_failed:
             # add a footer that shows all the stats
-            # one lulzy thing is that Goss does not have a way to skip tests so we hardcode to zero
             output += (os.linesep * 2) + "(Count: {}, Failed: {}, Skipped: {})".format(
-                result.get('tests_total'), result.get('tests_failed'), 0)
+                result.get('tests_total'), result.get('tests_failed'), result.get('tests_skipped') or 0)
+
+        if result.get('timings'):
+            output += os.linesep + self.format_timings(result.get('timings'))
 
         # insert a trailing newline for when running against multiple hosts
         output += os.linesep
@@ -52,6 +192,201 @@ class CallbackModule(CallbackBase):
         # emit output when successful or failed in the appropriate color
         self._display.display(output, color=C.COLOR_ERROR if failed else C.COLOR_OK)
 
+    def format_timings(self, timings):
+        """Format module phase timings as a footer, listing the sub-phases of each phase after it."""
+        parts = []
+
+        for phase in [name for name in timings if '.' not in name]:
+            details = ["{}: {:.3f}s".format(name.split('.', 1)[1], seconds) for name, seconds in timings.items()
+                if name.startswith(phase + '.')]
+
+            parts.append("{} {:.3f}s".format(phase, timings[phase]) +
+                (" ({})".format(", ".join(details)) if details else ""))
+
+        return "(Timings: {})".format(", ".join(parts))
+
+    def collect(self, task_result):
+        """Record the compact per-host statistics of a Goss run for the end of playbook summary."""
+        result, host = task_result._result, task_result._host.get_name()
+        timings = result.get('timings') or {}
+
+        self.host_stats.append(HostStats(
+            host=host,
+            module_failed=result.get('module_failed', False),
+            tests_total=result.get('tests_total') or 0,
+            tests_failed=result.get('tests_failed') or 0,
+            tests_skipped=result.get('tests_skipped') or 0,
+            goss_seconds=timings.get('test.goss'),
+            download_seconds=timings.get('install.download', result.get('download_seconds')),
+            download_bytes=result.get('download_bytes') or 0,
+        ))
+
+        for failure in result.get('failures') or []:
+            self.failures.setdefault(normalize_failure(failure, host), []).append(host)
+
+    def report(self, task_result):
+        """Stream a host's result to the report files as it arrives, so that memory use is independent of fleet size."""
+        host, result = task_result._host.get_name(), task_result._result
+
+        if self.ndjson_file:
+            if not self.ndjson:
+                self.ndjson = open(self.ndjson_file, 'w')
+
+            record = dict((key, result.get(key)) for key in ('msg', 'module_failed', 'tests_total', 'tests_failed',
+                'tests_skipped', 'failures', 'newly_failed', 'newly_passed', 'unchanged_count', 'test_result',
+                'timings', 'download_bytes'))
+            record['host'] = host
+
+            self.ndjson.write(json.dumps(record, sort_keys=True) + '\n')
+            self.ndjson.flush()
+
+        if self.junit_file:
+            if not self.junit:
+                self.junit = open(self.junit_file, 'w')
+                self.junit.write('<?xml version="1.0" encoding="UTF-8"?>\n<testsuites name="degoss">\n')
+
+            self.junit.write(self.format_junit(host, result))
+            self.junit.flush()
+
+    def format_junit(self, host, result):
+        """Format a host's result as a JUnit XML test suite."""
+        timings = result.get('timings') or {}
+        lines = []
+
+        if result.get('module_failed', False):
+            lines.append('  <testsuite name={} tests="1" failures="0" errors="1" skipped="0">'.format(xml_attr(host)))
+            lines.append('    <testcase classname={} name="degoss">'.format(xml_attr(host)))
+            lines.append('      <error message={}>{}</error>'.format(xml_attr(result.get('msg')),
+                xml_text(os.linesep.join(result.get('stdout_lines') or result.get('output_lines') or []))))
+            lines.append('    </testcase>')
+        else:
+            lines.append('  <testsuite name={} tests="{}" failures="{}" errors="0" skipped="{}" time="{:.3f}">'.format(
+                xml_attr(host), result.get('tests_total') or 0, result.get('tests_failed') or 0,
+                result.get('tests_skipped') or 0, timings.get('test.goss') or 0))
+
+            cases = (result.get('test_result') or {}).get('results')
+
+            if cases is None:
+                # the full results were not returned, so report the failures alone
+                cases = [{'summary-line': failure, 'successful': False} for failure in result.get('failures') or []]
+
+            for case in cases:
+                name = "{}: {}".format(case.get('resource-id', ''), case.get('property', '')).strip(': ') or \
+                    case.get('summary-line', '').splitlines()[0]
+                classname = "{}.{}".format(host, case.get('resource-type', 'goss'))
+
+                lines.append('    <testcase classname={} name={} time="{:.3f}">'.format(xml_attr(classname),
+                    xml_attr(name), (case.get('duration') or 0) / 1e9))
+
+                if case.get('skipped'):
+                    lines.append('      <skipped/>')
+                elif not case.get('successful'):
+                    summary_line = case.get('summary-line', '')
+                    lines.append('      <failure message={}>{}</failure>'.format(
+                        xml_attr(summary_line.splitlines()[0] if summary_line else ''), xml_text(summary_line)))
+
+                lines.append('    </testcase>')
+
+        lines.append('  </testsuite>')
+
+        return '\n'.join(lines) + '\n'
+
+    def close_reports(self):
+        """Finish and close the report files."""
+        if self.ndjson:
+            self.ndjson.close()
+            self.ndjson = None
+
+        if self.junit:
+            self.junit.write('</testsuites>\n')
+            self.junit.close()
+            self.junit = None
+
+    def summarize(self):
+        """Aggregate the per-host statistics of the playbook into a summary dictionary."""
+        summary = {
+            'hosts': len(self.host_stats),
+            'hosts_errored': sum(1 for stats in self.host_stats if stats.module_failed),
+            'hosts_failed': sum(1 for stats in self.host_stats if stats.tests_failed > 0),
+            'tests_total': sum(stats.tests_total for stats in self.host_stats),
+            'tests_failed': sum(stats.tests_failed for stats in self.host_stats),
+            'tests_skipped': sum(stats.tests_skipped for stats in self.host_stats),
+            'download_bytes': sum(stats.download_bytes for stats in self.host_stats),
+        }
+
+        for name in ('goss_seconds', 'download_seconds'):
+            values = sorted(getattr(stats, name) for stats in self.host_stats if getattr(stats, name) is not None)
+            summary[name] = dict(('p{}'.format(p), percentile(values, p)) for p in (50, 95, 99))
+
+        slowest = sorted((stats for stats in self.host_stats if stats.goss_seconds is not None),
+            key=lambda stats: stats.goss_seconds, reverse=True)[:SUMMARY_LIMIT]
+
+        summary['slowest_hosts'] = [{'host': stats.host, 'goss_seconds': stats.goss_seconds} for stats in slowest]
+        summary['common_failures'] = [{'failure': failure, 'hosts': len(hosts)}
+            for failure, hosts in self.get_failures()[:SUMMARY_LIMIT]]
+
+        return summary
+
+    def get_failures(self):
+        """Return each distinct normalized failure with the hosts it occurred on, most common first."""
+        return sorted(self.failures.items(), key=lambda failure: (-len(failure[1]), failure[0]))
+
+    def print_rollup(self):
+        """Print each distinct failure once along with the hosts it occurred on."""
+        lines = ["Degoss Failures: {} distinct failure(s)".format(len(self.failures))]
+
+        for failure, hosts in self.get_failures():
+            listed = ", ".join(hosts[:ROLLUP_HOST_LIMIT])
+
+            if len(hosts) > ROLLUP_HOST_LIMIT:
+                listed += ", and {} more".format(len(hosts) - ROLLUP_HOST_LIMIT)
+
+            lines.extend(["", "{} host(s): {}".format(len(hosts), listed)])
+            lines.extend((' ' * 2) + line for line in failure.splitlines())
+
+        self._display.display(os.linesep + os.linesep.join(lines) + os.linesep, color=C.COLOR_ERROR)
+
+    def print_summary(self, summary):
+        """Print the end of playbook summary across all hosts."""
+        def seconds(value):
+            return "-" if value is None else "{:.3f}s".format(value)
+
+        lines = [
+            "Degoss Summary: {} host(s), {} failed, {} errored; {} test(s), {} failed, {} skipped".format(
+                summary['hosts'], summary['hosts_failed'], summary['hosts_errored'], summary['tests_total'],
+                summary['tests_failed'], summary['tests_skipped']),
+            "",
+        ]
+
+        for label, name in (('Goss duration', 'goss_seconds'), ('Download duration', 'download_seconds')):
+            lines.append("  {:<18} p50 {}, p95 {}, p99 {}".format(label + ':', seconds(summary[name]['p50']),
+                seconds(summary[name]['p95']), seconds(summary[name]['p99'])))
+
+        lines.append("  {:<18} {} byte(s)".format('Downloaded:', summary['download_bytes']))
+
+        if summary['slowest_hosts']:
+            lines.extend(["", "  Slowest hosts:"])
+            lines.extend("    {} {}".format(seconds(entry['goss_seconds']), entry['host'])
+                for entry in summary['slowest_hosts'])
+
+        if summary['common_failures']:
+            lines.extend(["", "  Most common failures:"])
+            lines.extend("    {} host(s): {}".format(entry['hosts'], entry['failure'].splitlines()[0])
+                for entry in summary['common_failures'])
+
+        self._display.display(os.linesep + os.linesep.join(lines) + os.linesep)
+
+    def write_summary(self, summary):
+        """Write the summary to the summary file, per host as CSV or in aggregate as JSON."""
+        if self.summary_file.endswith('.csv'):
+            with open(self.summary_file, 'w') as f:
+                writer = csv.writer(f)
+                writer.writerow(HostStats._fields)
+                writer.writerows(self.host_stats)
+        else:
+            with open(self.summary_file, 'w') as f:
+                json.dump(summary, f, indent=2, sort_keys=True)
+
     def funnel(self, task_result):
         """
         Central ingress point for tasks and formatted output.
@@ -62,6 +397,8 @@ class CallbackModule(CallbackBase):
         if task_result._task.action == 'degoss':
             try:
                 self.pretty_print(task_result)
+                self.collect(task_result)
+                self.report(task_result)
             except Exception as e:
                 raise e
 
@@ -73,3 +410,19 @@ class CallbackModule(CallbackBase):
 
     def v2_runner_on_ok(self, result, ignore_errors=False):
         self.funnel(result)
+
+    def v2_playbook_on_stats(self, stats):
+        self.close_reports()
+
+        if not self.host_stats:
+            return
+
+        summary = self.summarize()
+
+        if self.rollup and self.failures:
+            self.print_rollup()
+
+        self.print_summary(summary)
+
+        if self.summary_file:
+            self.write_summary(summary)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, print_function
+
+import hashlib
+import io
+import os
+import re
+
+BUFFER_SIZE = 1024 * 1024
+# {{ .Vars.ansible_hostname }} and {{ range $.Vars.ansible_mounts }}
+VARS_FIELD_MATCHER = re.compile(r'\.Vars\.([A-Za-z0-9_]+)')
+# {{ index .Vars "ansible_hostname" }}
+VARS_INDEX_MATCHER = re.compile(r'index\s+\$?\.Vars\s+"([^"]+)"')
+# any other use of .Vars as a whole, e.g. {{ range $key, $value := .Vars }}, which could reference any variable
+VARS_WHOLE_MATCHER = re.compile(r'\.Vars(?![A-Za-z0-9_.])')
+
+
+def resolve_paths(paths, base_dir):
+    """Resolve test file and directory paths relative to the base directory, as the role deploys them."""
+    return [path if os.path.isabs(path) else os.path.join(base_dir, path) for path in paths if path]
+
+
+def bundle_entries(paths, base_dir='.'):
+    """
+    Return the directory to archive each test file or directory from and the name to archive it as.
+
+    As when copying them, a directory with a trailing slash is deployed as its contents rather than as itself.
+    """
+    return [(path, '.') if path.endswith(os.sep) else (os.path.dirname(path), os.path.basename(path))
+        for path in resolve_paths(paths, base_dir)]
+
+
+def walk_files(paths):
+    """Yield every file in the given list of files and directories."""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+
+                for name in sorted(files):
+                    yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def referenced_vars(paths, base_dir='.'):
+    """
+    Scan Goss test files for the variables they reference.
+
+    Returns a sorted list of variable names, or None if a test file uses .Vars as a whole, in which case any variable
+    may be referenced.
+    """
+    names = set()
+
+    for path in walk_files(resolve_paths(paths, base_dir)):
+        with io.open(path, 'r', encoding='utf-8', errors='replace') as f:
+            content = f.read()
+
+        names.update(VARS_FIELD_MATCHER.findall(content))
+        names.update(VARS_INDEX_MATCHER.findall(content))
+
+        if VARS_WHOLE_MATCHER.search(VARS_INDEX_MATCHER.sub('', content)):
+            return None
+
+    return sorted(names)
+
+
+def select_facts(facts, names, allowlist=None):
+    """
+    Select only the named facts from ansible_facts.
+
+    Names may be given with or without the ansible_ prefix which degoss adds to facts; a names value of None selects
+    all facts.
+    """
+    if names is None:
+        return facts
+
+    wanted = set()
+
+    for name in list(names) + list(allowlist or []):
+        wanted.add(name)
+        wanted.add(name[len('ansible_'):] if name.startswith('ansible_') else name)
+
+    return dict((key, value) for key, value in facts.items() if key in wanted)
+
+
+def tree_hash(paths, base_dir='.'):
+    """
+    Hash the names and contents of test files and directories as they are deployed, i.e. as they are archived.
+
+    The hash addresses a bundle of the tests, so that it only needs to be built and shipped when the tests change.
+    """
+    digest = hashlib.sha256()
+
+    for parent, name in bundle_entries(paths, base_dir):
+        for file_path in walk_files([os.path.join(parent, name)]):
+            digest.update(os.path.relpath(file_path, parent).encode('utf-8') + b'\0')
+
+            with io.open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(BUFFER_SIZE), b''):
+                    digest.update(chunk)
+
+            digest.update(b'\0')
+
+    return digest.hexdigest()
+
+
+class FilterModule(object):
+
+    def filters(self):
+        return {
+            'degoss_bundle_entries': bundle_entries,
+            'degoss_referenced_vars': referenced_vars,
+            'degoss_resolve_paths': resolve_paths,
+            'degoss_select_facts': select_facts,
+            'degoss_tree_hash': tree_hash,
+        }
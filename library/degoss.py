@@ -4,25 +4,30 @@
 from __future__ import absolute_import, print_function
 
 from ansible.module_utils import six
-from ansible.module_utils.basic import *
-
+from ansible.module_utils.basic import AnsibleModule, missing_required_lib
+
+# note: urllib, socket, gzip, tarfile, multiprocessing, and glob are imported where they are used, as most runs never
+# need them and they account for much of the import time left over by AnsibleModule; AnsibleModule already imports the
+# rest of these
+import codecs
+import contextlib
+import fcntl
+import hashlib
 import json
 import logging
 import os
 import platform
+import re
 import shutil
+import signal
 import stat
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 
-
-if six.PY3:
-    from io import StringIO
-    from urllib.request import Request, urlopen
-else:
-    from StringIO import StringIO
-    from urllib2 import Request, urlopen
+from collections import OrderedDict, deque
 
 
 DOCUMENTATION = """
@@ -33,6 +38,53 @@ short_description: Download, execute, and remove Goss against test cases.
 description:
     - Download, execute, and remove Goss against test cases located on disk.
 options:
+    baseline:
+        type: bool
+        required: false
+        default: false
+        description: >
+            If true, keep the outcome of each check in state_dir and return the checks which newly failed or newly
+            passed since the previous run.
+    base_workdir:
+        type: path
+        required: false
+        default: system temporary directory
+        description: The directory in which to create tmp_root, if it is not given.
+    binary_path:
+        type: path
+        required: false
+        default: null
+        description: If set, a Goss binary already on the host to install instead of downloading one.
+    bundle:
+        type: path
+        required: false
+        default: null
+        description: >
+            A tar archive of the test files on the host, which is unpacked into a directory beside it named after the
+            archive and used as test_dir. The archive is only unpacked once. Other bundles beside it which are named
+            after a SHA-256 hash and were not used within an hour are removed. Unless keep_bundle is true, the bundle
+            is removed when cleaning up. Its directory must be owned by the current user or root and writable only by
+            its owner.
+    cache_dir:
+        type: path
+        required: false
+        default: null
+        description: If set, a directory on the host in which to cache verified Goss binaries between runs.
+    cache_max_age:
+        type: int
+        required: false
+        default: 604800
+        description: Maximum age in seconds of a cached Goss binary before it is evicted, 0 disables age eviction.
+    cache_max_size:
+        type: int
+        required: false
+        default: 104857600
+        description: Maximum total size in bytes of the binary cache before older binaries are evicted, 0 disables it.
+    checksum:
+        type: str
+        required: false
+        default: null
+        description: The expected SHA-256 checksum of the downloaded Goss binary, overriding the published checksum.
     clean:
         type: bool
         required: false
@@ -48,90 +100,651 @@ options:
         required: false
         default: false
         description: Set the logger level to debug instead of the default, which is info.
+    keep_bundle:
+        type: bool
+        required: false
+        default: false
+        description: >
+            If true, keep the bundle and its unpacked tests for later runs instead of removing them when cleaning up.
+            The directory of the bundle must then be owned by the current user or root and writable only by its
+            owner, such as a directory in /var/lib.
+    log_buffer_lines:
+        type: int
+        required: false
+        default: 1000
+        description: The number of most recent log lines kept in memory and returned when the module fails.
+    max_concurrent:
+        type: int
+        required: false
+        default: null
+        description: Passed to Goss as --max-concurrent, the maximum number of tests Goss runs concurrently.
+    offline:
+        type: bool
+        required: false
+        default: false
+        description: If true, never make network requests; only binary_path, cache_dir, or file:// URLs are used.
     facts:
         type: dict
         required: false
         default: empty dictionary
         description: A dictionary of Ansible facts to securely pass into the Goss execution.
+    persistent_log:
+        type: path
+        required: false
+        default: null
+        description: If set, a log file outside of tmp_root which is appended to by every run and rotated by size.
+    persistent_log_backups:
+        type: int
+        required: false
+        default: 3
+        description: The number of rotated persistent log files to keep.
+    persistent_log_max_bytes:
+        type: int
+        required: false
+        default: 10485760
+        description: The size in bytes at which the persistent log file is rotated.
+    release_url:
+        type: str
+        required: false
+        default: null
+        description: A URL template for the Goss binary with {version}, {os}, and {arch} placeholders, e.g. a mirror or file:// path.
+    result_detail:
+        type: str
+        required: false
+        default: full
+        choices: [full, failures_only, summary]
+        description: >
+            How much of the Goss result document to return: all of it, only the failed results, or only the summary. The
+            full document is always written to result_file on the host.
+    resident:
+        type: bool
+        required: false
+        default: false
+        description: >
+            If true, keep the Goss binary, tests, and variables in resident_dir and validate against a long-lived
+            goss serve process on 127.0.0.1, restarting it only when any of them change.
+    resident_dir:
+        type: path
+        required: false
+        default: /var/lib/degoss
+        description: The persistent directory for resident mode.
+    resident_port:
+        type: int
+        required: false
+        default: null
+        description: The local port for the resident Goss server to listen on, by default a free port.
+    result_archive:
+        type: path
+        required: false
+        default: null
+        description: >
+            A path outside of tmp_root to write the result file to, so that it survives cleanup and can be fetched. It
+            is compressed if it ends in .gz. If it is a directory, the result file is named after tmp_root in it.
+    result_compression:
+        type: str
+        required: false
+        default: gzip
+        choices: [gzip, none]
+        description: Whether to gzip the result file written to tmp_root.
+    resource_types:
+        type: list
+        required: false
+        default: []
+        description: If set, only test resources of these types, e.g. file or service, and skip all others.
+    retry_timeout:
+        type: str
+        required: false
+        default: null
+        description: Passed to Goss as --retry-timeout, how long Goss retries failing tests, e.g. 30s.
+    render_cache:
+        type: bool
+        required: false
+        default: false
+        description: >
+            If true, cache the test files rendered by goss render in cache_dir, keyed by a hash of the Goss version,
+            the test directory, and the variables, and validate the rendered test files when none of them changed.
+    repo_url:
+        type: str
+        required: false
+        default: https://github.com/aelsabbahy/goss
+        description: The base URL of a GitHub-compatible Goss release repository or mirror.
+    select:
+        type: str
+        required: false
+        default: all
+        choices: [all, failed_only, failed_first]
+        description: >
+            Which tests to run: all of them, only those which failed in the previous run, or those first and all
+            others only if they now pass. Selecting previously failed tests requires state_dir and runs all tests when
+            there is no record of a previous run. Unselected tests are reported as skipped. Ignored in resident mode.
+    sleep:
+        type: str
+        required: false
+        default: null
+        description: Passed to Goss as --sleep, how long Goss waits between retries, e.g. 1s.
+    state_dir:
+        type: path
+        required: false
+        default: null
+        description: If set, a persistent directory on the host in which to record the tests which failed.
+    stream_results:
+        type: bool
+        required: false
+        default: false
+        description: If true, parse Goss results as they are produced and only keep failures and the summary in memory.
+    stream_variables:
+        type: bool
+        required: false
+        default: false
+        description: If true, stream variables to Goss as they are encoded rather than serializing them up front.
+    tags:
+        type: list
+        required: false
+        default: []
+        description: If set, only test resources with any of these tags in their meta tags, and skip all others.
     test_dir:
         type: path
-        required: true
+        required: false
+        default: the unpacked bundle, otherwise tmp_root/tests
         description: The directory in which test files are located.
     test_file:
-        type: str
+        type: list
         required: true
-        description: The test file to execute Goss against.
+        description: The test file(s) to execute Goss against, which may be glob patterns relative to test_dir.
+    timeout:
+        type: int
+        required: false
+        default: null
+        description: Wall-clock seconds after which all Goss processes are killed and the run fails as timed out.
     tmp_root:
         type: path
-        required: true
+        required: false
+        default: a new directory in base_workdir
         description: The temporary root directory to remove after running.
+    workers:
+        type: int
+        required: false
+        default: number of CPUs
+        description: The maximum number of test files to execute concurrently.
     variables:
         type: dict
         required: false
         default: empty dictionary
         description: A dictionary of variables to pass into the Goss execution.
+    verify_checksum:
+        type: bool
+        required: false
+        default: true
+        description: If true, verify the downloaded Goss binary against the checksum published alongside it.
     version:
         type: str
         required: false
         default: latest
         description: If latest, the latest available Goss version, otherwise the specified version, e.g. 0.3.6.
+    version_cache_ttl:
+        type: int
+        required: false
+        default: 3600
+        description: Seconds for which a resolved latest version is reused from cache_dir, 0 disables it.
 examples: []
 """
 
+# maps platform.uname() machine names to the architecture names Goss publishes binaries under
+ARCH_ALIASES = {
+    'x86_64': 'amd64',
+    'i386': '386',
+}
+# checks are identified by a truncated hash, which is plenty to tell the checks of a host apart
+BASELINE_KEY_LENGTH = 16
 BOOLEAN_TRUE_MATCHER = re.compile(r'(true|yes|on)', re.I)
-BUFFER_SIZE=8192
+BUFFER_SIZE = 1024 * 1024
+# bundles are named after the hash of the tests they contain
+BUNDLE_MATCHER = re.compile(r'^[0-9a-f]{64}(\.tar\.gz|\.tgz|\.tar)?$')
+BUNDLE_SUFFIXES = ('.tar.gz', '.tgz', '.tar')
+# bundles used more recently than this may belong to a concurrent run, so they are not pruned yet
+BUNDLE_PRUNE_AGE = 3600
+CACHE_LOCK_FILE = '.lock'
+CACHE_TEMP_MAX_AGE = 3600
+CACHE_VERSION_FILE = 'latest-version.json'
+CHECKSUM_SUFFIX = '.sha256'
+CAPTURED_OUTPUT_LIMIT = 1024 * 1024
 CONSOLE_LOGGING_FORMAT = '[%(levelname)-5s] %(message)s'
 DISK_LOGGING_FORMAT = '%(asctime)s [%(levelname)-5s] %(name)s: %(message)s'
+DOWNLOAD_ATTEMPTS = 3
+# the characters which make a path a glob pattern, as glob.has_magic checks for them
+GLOB_MATCHER = re.compile(r'[*?[]')
+# returned while parsing a value which has not been produced entirely yet, as null is a valid value
+INCOMPLETE = object()
+# favor speed over size, most of the savings come from the repetitive structure of result documents
+RESULT_COMPRESSION_LEVEL = 6
 REPO_URL = "https://github.com/aelsabbahy/goss"
+RENDER_CACHE_DIR = 'rendered'
+# goss serve caches results for 5s by default, which would report stale results right after a change
+RESIDENT_CACHE_TTL = '1ms'
+RESIDENT_GOSSFILE = 'degoss.yml'
+RESIDENT_POLL_INTERVAL = 0.1
+RESIDENT_START_TIMEOUT = 30
+RESIDENT_STATE_FILE = 'state.json'
+STATE_BASELINE_FILE = 'baseline.json'
+STATE_FAILED_FILE = 'failed.json'
+# goss templates every test file it reads, so rendered test files print this wherever they contain a template delimiter
+TEMPLATE_ESCAPE = '{{"{{"}}'
+WHITESPACE_MATCHER = re.compile(r'\s*')
+
+# a clock which never goes backwards where available, python 2 only has the wall clock
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+def cpu_count():
+    """Return the number of CPUs, without importing multiprocessing where os can tell."""
+    if hasattr(os, 'cpu_count'):
+        return os.cpu_count() or 1
+
+    import multiprocessing
+
+    return multiprocessing.cpu_count()
 
 
 def main(argv=sys.argv):
     """Main entrypoint into the module, instantiates and executes the service."""
     Degoss(argv, AnsibleModule(
         argument_spec=dict(
+            baseline=dict(type='bool', required=False, default=False),
+            base_workdir=dict(type='path', required=False, default=None),
+            binary_path=dict(type='path', required=False, default=None),
+            bundle=dict(type='path', required=False, default=None),
+            cache_dir=dict(type='path', required=False, default=None),
+            cache_max_age=dict(type='int', required=False, default=604800),
+            cache_max_size=dict(type='int', required=False, default=104857600),
+            checksum=dict(type='str', required=False, default=None),
             clean=dict(type='bool', required=False, default=True),
             clean_on_failure=dict(type='bool', required=False, default=True),
             debug=dict(type='bool', required=False, default=False),
+            keep_bundle=dict(type='bool', required=False, default=False),
             facts=dict(type='dict', required=False, default='{}'),
-            test_dir=dict(type='path', required=True),
-            test_file=dict(type='str', required=True),
-            tmp_root=dict(type='path', required=True),
+            log_buffer_lines=dict(type='int', required=False, default=1000),
+            max_concurrent=dict(type='int', required=False, default=None),
+            offline=dict(type='bool', required=False, default=False),
+            persistent_log=dict(type='path', required=False, default=None),
+            persistent_log_backups=dict(type='int', required=False, default=3),
+            persistent_log_max_bytes=dict(type='int', required=False, default=10485760),
+            release_url=dict(type='str', required=False, default=None),
+            result_detail=dict(type='str', required=False, default='full',
+                choices=['full', 'failures_only', 'summary']),
+            resident=dict(type='bool', required=False, default=False),
+            resident_dir=dict(type='path', required=False, default='/var/lib/degoss'),
+            resident_port=dict(type='int', required=False, default=None),
+            result_archive=dict(type='path', required=False, default=None),
+            result_compression=dict(type='str', required=False, default='gzip', choices=['gzip', 'none']),
+            resource_types=dict(type='list', required=False, default=[]),
+            render_cache=dict(type='bool', required=False, default=False),
+            retry_timeout=dict(type='str', required=False, default=None),
+            repo_url=dict(type='str', required=False, default=REPO_URL),
+            select=dict(type='str', required=False, default='all',
+                choices=['all', 'failed_only', 'failed_first']),
+            sleep=dict(type='str', required=False, default=None),
+            state_dir=dict(type='path', required=False, default=None),
+            stream_results=dict(type='bool', required=False, default=False),
+            stream_variables=dict(type='bool', required=False, default=False),
+            tags=dict(type='list', required=False, default=[]),
+            test_dir=dict(type='path', required=False, default=None),
+            test_file=dict(type='list', required=True),
+            timeout=dict(type='int', required=False, default=None),
+            tmp_root=dict(type='path', required=False, default=None),
             variables=(dict(type='dict', required=False, default='{}')),
+            verify_checksum=dict(type='bool', required=False, default=True),
             version=dict(type='str', required=False, default='latest'),
+            version_cache_ttl=dict(type='int', required=False, default=3600),
+            workers=dict(type='int', required=False, default=None),
         )
     )).execute()
 
 
+def check_key(result):
+    """Hash what identifies a Goss check across runs: its resource type, resource ID, and property."""
+    identity = json.dumps([normalize_type(result.get('resource-type', '')), result.get('resource-id'),
+        result.get('property')])
+
+    return hashlib.sha256(identity.encode('utf-8')).hexdigest()[:BASELINE_KEY_LENGTH]
+
+
+def escape_template(text):
+    """Escape rendered test file text so that Goss templating it once more leaves it as it is."""
+    return text.replace('{{', TEMPLATE_ESCAPE)
+
+
+def unescape_template(text):
+    """Reverse escape_template."""
+    return text.replace(TEMPLATE_ESCAPE, '{{')
+
+
+def normalize_type(resource_type):
+    """Normalize a Goss resource type, as named in test files, e.g. http, or in results, e.g. HTTP."""
+    return resource_type.lower().replace('-', '').replace('_', '')
+
+
+def sha256sum(path):
+    """Return the hex SHA-256 digest of the file at the given path."""
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        chunk = f.read(BUFFER_SIZE)
+
+        while chunk:
+            digest.update(chunk)
+            chunk = f.read(BUFFER_SIZE)
+
+    return digest.hexdigest()
+
+
+class ResultStreamParser(object):
+    """
+    Incrementally parses a Goss JSON result document as it is produced.
+
+    Each entry of the top-level results array is handed to a callback as soon as it is complete, so that the entire
+    document never needs to be held in memory; all other top-level values, e.g. the summary, are kept.
+    """
+
+    def __init__(self, on_result):
+        self.on_result = on_result
+        self.decoder = json.JSONDecoder()
+        self.buffer, self.pos, self.state, self.key = '', 0, 'start', None
+        self.document = {}
+
+    @property
+    def complete(self):
+        """Return whether an entire document has been parsed."""
+        return self.state == 'done'
+
+    @property
+    def failed(self):
+        """Return whether the input was not a JSON object."""
+        return self.state == 'failed'
+
+    def feed(self, data):
+        """Parse the next chunk of the document."""
+        if self.complete or self.failed:
+            return
+
+        # drop everything already parsed so that the buffer only ever holds the current partial value
+        self.buffer, self.pos = self.buffer[self.pos:] + data, 0
+
+        while self.parse_next():
+            pass
+
+    def parse_next(self):
+        """Parse the next token or value in the buffer, returning False when more input is needed."""
+        self.pos = WHITESPACE_MATCHER.match(self.buffer, self.pos).end()
+
+        if self.pos >= len(self.buffer):
+            return False
+
+        char = self.buffer[self.pos]
+
+        if self.state == 'start':
+            return self.expect(char, {'{': 'key'})
+        elif self.state == 'key':
+            if char == '}':
+                return self.expect(char, {'}': 'done'})
+
+            self.key = self.decode(str)
+
+            return self.key is not INCOMPLETE and self.transition('colon')
+        elif self.state == 'colon':
+            return self.expect(char, {':': 'results' if self.key == 'results' else 'value'})
+        elif self.state == 'value':
+            value = self.decode()
+
+            if value is INCOMPLETE:
+                return False
+
+            self.document[self.key] = value
+
+            return self.transition('next')
+        elif self.state == 'results' and char == 'n':
+            # goss reports no results at all as null
+            value = self.decode()
+
+            if value is INCOMPLETE:
+                return False
+
+            return self.transition('next' if value is None else 'failed')
+        elif self.state == 'results':
+            return self.expect(char, {'[': 'first_result'})
+        elif self.state == 'first_result' and char == ']':
+            return self.expect(char, {']': 'next'})
+        elif self.state in ('first_result', 'result'):
+            result = self.decode(dict)
+
+            if result is INCOMPLETE:
+                return False
+
+            self.on_result(result)
+
+            return self.transition('result_separator')
+        elif self.state == 'result_separator':
+            return self.expect(char, {',': 'result', ']': 'next'})
+        elif self.state == 'next':
+            return self.expect(char, {',': 'key', '}': 'done'})
+
+        return False
+
+    def expect(self, char, transitions):
+        """Consume a structural character and transition, or mark the input as failed if it is unexpected."""
+        if char not in transitions:
+            return self.transition('failed')
+
+        self.pos += 1
+
+        return self.transition(transitions[char])
+
+    def transition(self, state):
+        """Move to the given state, returning whether parsing can continue."""
+        self.state = state
+
+        return state not in ('done', 'failed')
+
+    def decode(self, expected_type=None):
+        """Decode a complete value at the current position, returning INCOMPLETE if the value is still incomplete."""
+        try:
+            value, end = self.decoder.raw_decode(self.buffer, self.pos)
+        except ValueError:
+            # either incomplete, or not JSON at all, which is detected when the output ends
+            return INCOMPLETE
+
+        if end == len(self.buffer) and isinstance(value, (int, float)):
+            # a number at the end of the buffer may still have more digits coming
+            return INCOMPLETE
+
+        if expected_type is str and not isinstance(value, six.string_types) or \
+                expected_type is dict and not isinstance(value, dict):
+            self.transition('failed')
+            return INCOMPLETE
+
+        self.pos = end
+
+        return value
+
+
+def open_result(path):
+    """Open a result file for writing text which only the current user can read, compressing it if named .gz."""
+    # results may be archived outside the private temporary root, so create the file private before writing to it
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o0600)
+    os.fchmod(fd, 0o0600)
+    os.close(fd)
+
+    if not path.endswith('.gz'):
+        return open(path, 'w')
+
+    import gzip
+
+    if six.PY3:
+        return gzip.open(path, 'wt', RESULT_COMPRESSION_LEVEL, encoding='utf-8')
+
+    return gzip.open(path, 'wb', RESULT_COMPRESSION_LEVEL)
+
+
+class BufferHandler(logging.Handler):
+    """A logging handler which keeps formatted log lines in a buffer, e.g. a bounded deque."""
+
+    def __init__(self, buffer):
+        # logging.Handler is an old-style class on python 2
+        logging.Handler.__init__(self)
+        self.buffer = buffer
+
+    def emit(self, record):
+        try:
+            self.buffer.extend(line for line in self.format(record).split(os.linesep) if len(line) > 0)
+        except Exception:
+            self.handleError(record)
+
+
+class ResultWriter(object):
+    """Progressively writes Goss results to a JSON document on disk, safe to share between concurrent test files."""
+
+    def __init__(self, path):
+        self.file, self.count, self.lock = open_result(path), 0, threading.Lock()
+        self.file.write('{"results":[')
+
+    def write(self, result):
+        """Append a single result to the document."""
+        encoded = json.dumps(result)
+
+        with self.lock:
+            self.file.write(',' + encoded if self.count else encoded)
+            self.count += 1
+
+    def close(self, summary=None):
+        """Finish the document with the summary, if any, and close it."""
+        if self.file.closed:
+            return
+
+        self.file.write('],"summary":{}}}'.format(json.dumps(summary or {})))
+        self.file.close()
+
+
+class BaselineDiff(object):
+    """
+    Diffs Goss results one at a time against the outcome of each check in a previous run, if any, and records the
+    outcomes of this run. Skipped checks keep their previous outcome.
+    """
+
+    def __init__(self, previous):
+        self.previous, self.current, self.lock = previous, {}, threading.Lock()
+        self.newly_failed, self.newly_passed, self.unchanged_count = [], [], 0
+
+    def add(self, result):
+        """Diff a single result against the baseline."""
+        key = check_key(result)
+        previous = self.previous.get(key) if self.previous is not None else None
+
+        with self.lock:
+            if result.get('skipped'):
+                if previous is not None:
+                    self.current[key] = previous
+
+                return
+
+            outcome = 1 if result.get('successful') else 0
+            self.current[key] = outcome
+
+            if self.previous is None:
+                # there is nothing to compare against on the first run
+                return
+
+            if outcome == previous:
+                self.unchanged_count += 1
+            elif not outcome:
+                # includes checks which were not in the baseline yet
+                self.newly_failed.append(result.get('summary-line'))
+            elif previous == 0:
+                self.newly_passed.append(result.get('summary-line'))
+
+    def get_deltas(self):
+        """Return the module result values of the diff, which are null on the first run."""
+        if self.previous is None:
+            return {'newly_failed': None, 'newly_passed': None, 'unchanged_count': None}
+
+        return {
+            'newly_failed': self.newly_failed,
+            'newly_passed': self.newly_passed,
+            'unchanged_count': self.unchanged_count,
+        }
+
+
 class Degoss(object):
 
     def __init__(self, argv, module):
         """Constructor for a Degoss service."""
         # instantiate independent variables first
         self.argv = argv
-        self.log_output = StringIO()
         self.module = module
+        self.log_output = deque(maxlen=max(1, self.module.params.get('log_buffer_lines') or 1000))
 
         # establish input parameters
+        self.baseline = self.get_bool('baseline', False)
+        self.base_workdir = self.module.params.get('base_workdir') or tempfile.gettempdir()
+        self.binary_path = self.module.params.get('binary_path')
+        self.bundle = self.module.params.get('bundle')
+        self.cache_dir = self.module.params.get('cache_dir')
+        self.cache_max_age = self.module.params.get('cache_max_age', 0) or 0
+        self.cache_max_size = self.module.params.get('cache_max_size', 0) or 0
+        self.checksum = self.module.params.get('checksum')
         self.debug = self.get_bool('debug', False)
         self.clean_on_failure = module.params.get('clean_on_failure')
         self.do_clean = self.get_bool('clean', True)
         self.facts = self.module.params.get('facts', {})
+        self.keep_bundle = self.get_bool('keep_bundle', False)
+        self.max_concurrent = self.module.params.get('max_concurrent')
+        self.offline = self.get_bool('offline', False)
+        self.persistent_log = self.module.params.get('persistent_log')
+        self.persistent_log_backups = self.module.params.get('persistent_log_backups') or 0
+        self.persistent_log_max_bytes = self.module.params.get('persistent_log_max_bytes') or 0
+        self.release_url = self.module.params.get('release_url')
+        self.resident = self.get_bool('resident', False)
+        self.resident_dir = self.module.params.get('resident_dir') or '/var/lib/degoss'
+        self.resident_port = self.module.params.get('resident_port')
+        self.result_archive = self.module.params.get('result_archive')
+        self.result_compression = self.module.params.get('result_compression') or 'gzip'
+        self.result_detail = self.module.params.get('result_detail') or 'full'
+        self.render_cache = self.get_bool('render_cache', False)
+        self.resource_types = self.module.params.get('resource_types') or []
+        self.retry_timeout = self.module.params.get('retry_timeout')
+        self.select = self.module.params.get('select') or 'all'
+        self.sleep = self.module.params.get('sleep')
+        self.state_dir = self.module.params.get('state_dir')
+        self.stream_results = self.get_bool('stream_results', False)
+        self.stream_variables = self.get_bool('stream_variables', False)
+        self.tags = self.module.params.get('tags') or []
+        self.timeout = self.module.params.get('timeout')
+        self.repo_url = (self.module.params.get('repo_url') or REPO_URL).rstrip('/')
         self.requested_version, self._version = module.params.get('version', 'latest'), None
-        self.test_dir = self.module.params.get('test_dir')
-        self.test_file = self.module.params.get('test_file').split(os.sep)[-1]
-        self.tmp_root = self.module.params.get('tmp_root')
+        self.tmp_root = self.module.params.get('tmp_root') or tempfile.mkdtemp(prefix='degoss.', dir=self.base_workdir)
+        self.test_dir = self.module.params.get('test_dir') or self.get_bundle_dir() or \
+            os.path.join(self.tmp_root, 'tests')
+        test_files = self.module.params.get('test_file')
+        self.test_files = [test_files] if isinstance(test_files, six.string_types) else list(test_files)
+        self.test_file = self.test_files[0].split(os.sep)[-1]
         self.variables = self.module.params.get('variables', {})
+        self.verify_checksum = self.get_bool('verify_checksum', True)
+        self.version_cache_ttl = self.module.params.get('version_cache_ttl', 0) or 0
+        self.workers = max(1, self.module.params.get('workers') or cpu_count())
 
         self._has_run, self._errored = False, False
         self.test_result, self.total_tests, self.failed_tests, self.failed_messages = None, None, None, None
+        self.skipped_tests, self.streamed_skipped, self.selected_names, self.selected_resources = None, {}, {}, None
+        self.baseline_diff = None
+        self.download_bytes, self.download_seconds = 0, 0.0
+        self.file_results, self.deadline, self.timed_out_files = None, None, []
+        self.result_writer, self.resident_process, self.setup, self.timings = None, None, None, OrderedDict()
 
         # establish directories and files
         self.bin_dir, self.executable, self.log_dir, self.log_file, self.result_file = \
-            os.path.join(self.tmp_root, 'bin'), \
-            os.path.join(self.tmp_root, 'bin', 'goss'), \
+            os.path.join(self.resident_dir if self.resident else self.tmp_root, 'bin'), \
+            os.path.join(self.resident_dir if self.resident else self.tmp_root, 'bin', 'goss'), \
             os.path.join(self.tmp_root, 'logs'), \
             os.path.join(self.tmp_root, 'logs', 'degoss.log'), \
-            os.path.join(self.tmp_root, 'result.json') \
+            self.get_result_file()
 
         # now that all independent variables are initialized, call initialization methods
         self.logger = None
@@ -140,6 +753,30 @@ class Degoss(object):
         self.os, self.arch = None, None
 
 
+    def get_bundle_dir(self):
+        """Return the directory which the test bundle is unpacked into, beside the bundle and named after it."""
+        if not self.bundle:
+            return None
+
+        for suffix in BUNDLE_SUFFIXES:
+            if self.bundle.endswith(suffix):
+                return self.bundle[:-len(suffix)]
+
+        return self.bundle + '.d'
+
+    def get_result_file(self):
+        """Return the path to write the Goss result document to."""
+        name = 'result.json.gz' if self.result_compression == 'gzip' else 'result.json'
+
+        if not self.result_archive:
+            return os.path.join(self.tmp_root, name)
+
+        if self.result_archive.endswith(os.sep) or os.path.isdir(self.result_archive):
+            # name the result after the temporary root, which is unique
+            return os.path.join(self.result_archive, "{}.{}".format(os.path.basename(self.tmp_root), name))
+
+        return self.result_archive
+
     def initialize(self):
         """Initialize the module."""
         # create runtime directories
@@ -153,32 +790,119 @@ class Degoss(object):
 
         self.logger.debug("Detected host operating system (%s) and architecture (%s).", self.os, self.arch)
 
+        if self.bundle:
+            with self.timed('initialize.tests'):
+                self.unpack_bundle()
+
+    def unpack_bundle(self):
+        """
+        Unpack the test bundle into the test directory unless it already has been, and remove outdated bundles.
+
+        This replaces creating a temporary directory, creating the test directory, and copying each test file or
+        directory over separate module executions.
+        """
+        if not os.path.isfile(self.bundle):
+            self.fail("Test bundle {} does not exist on the host".format(self.bundle))
+            return
+
+        # Goss runs the commands in the tests, and a Goss binary may be pushed beside them, so they must only be used
+        # from a directory which nobody else could have written to
+        for path in (os.path.dirname(self.bundle), self.test_dir):
+            if os.path.lexists(path) and not self.is_private(path):
+                self.fail("Refusing to use {}, which is not a directory owned by the current user or root and "
+                    "writable only by its owner".format(path))
+                return
+
+        import tarfile
+
+        with tarfile.open(self.bundle, 'r:*') as archive:
+            members = archive.getmembers()
+            entries = set(member.name.split('/')[0] for member in members)
+
+            if os.path.isdir(self.test_dir):
+                self.logger.info("Using the test bundle already unpacked in %s", self.test_dir)
+
+                # mark the bundle as in use, so that runs of other tests do not prune it
+                for path in (self.bundle, self.test_dir):
+                    os.utime(path, None)
+            else:
+                for member in members:
+                    parts = member.name.split('/')
+
+                    if os.path.isabs(member.name) or '..' in parts or not (member.isfile() or member.isdir()):
+                        self.fail("Refusing to unpack {} from test bundle {}".format(member.name, self.bundle))
+                        return
+
+                self.logger.info("Unpacking %d test file(s) from %s into %s", len(members), self.bundle, self.test_dir)
+
+                # unpack beside the test directory and move it into place, so it is never seen partially unpacked
+                staging = tempfile.mkdtemp(prefix='.degoss.', dir=os.path.dirname(self.test_dir))
+
+                if hasattr(tarfile, 'data_filter'):
+                    archive.extractall(staging, members, filter='data')
+                else:
+                    archive.extractall(staging, members)
+
+                try:
+                    os.rename(staging, self.test_dir)
+                except OSError:
+                    # another run unpacked the same bundle in the meantime
+                    shutil.rmtree(staging)
+
+                self.prune_bundles()
+
+        # the role used to run mktemp, create the test directory, and copy each entry; it still runs mktemp for
+        # bundles which are not kept
+        self.setup = {'files': len(members), 'round_trips_saved': (2 if self.keep_bundle else 1) + len(entries)}
+
+    def is_private(self, path):
+        """Return whether a path is a directory owned by the current user or root and writable only by its owner."""
+        st = os.lstat(path)
+
+        return stat.S_ISDIR(st.st_mode) and st.st_uid in (os.geteuid(), 0) and not st.st_mode & 0o022
+
+    def prune_bundles(self):
+        """Remove bundles of outdated tests beside the current one, unless they were used recently."""
+        parent, current = os.path.dirname(self.bundle), os.path.basename(self.test_dir)
+        now = time.time()
+
+        for name in os.listdir(parent):
+            path = os.path.join(parent, name)
+
+            if BUNDLE_MATCHER.match(name) and not name.startswith(current) and \
+                    now - os.lstat(path).st_mtime > BUNDLE_PRUNE_AGE:
+                self.logger.debug("Removing the outdated test bundle %s", name)
+
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+
     def detect_environment(self):
         """Detect the runtime environment on the host."""
         uname = platform.uname()
 
         current_os, current_arch = uname[0].lower(), uname[4]
 
-        if current_arch == 'x86_64':
-            # goss publishes as goss-linux-amd64
-            current_arch = 'amd64'
-        elif current_arch == 'i386':
-            # goss publishes as goss-linux-386
-            current_arch = '386'
-
-        return current_os, current_arch
+        # goss publishes as e.g. goss-linux-amd64 and goss-linux-386
+        return current_os, ARCH_ALIASES.get(current_arch, current_arch)
 
     def setup_logging(self):
         """Setup logging for the module based on parameters."""
         # rewrite warning to warn
         logging.addLevelName(30, 'WARN')
 
+        logger = logging.getLogger('degoss')
+
+        # the logger is global, so remove the handlers of any previous run in this process rather than adding to them
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+
         # configure output handlers
-        buffer_handler = logging.StreamHandler(stream=self.log_output)
+        buffer_handler = BufferHandler(self.log_output)
         buffer_handler.setFormatter(logging.Formatter(CONSOLE_LOGGING_FORMAT))
 
-        logger = logging.getLogger('degoss')
-
         # catchall handler for saving output
         logger.addHandler(buffer_handler)
 
@@ -187,16 +911,32 @@ class Degoss(object):
         disk_handler.setFormatter(logging.Formatter(DISK_LOGGING_FORMAT))
         logger.addHandler(disk_handler)
 
+        if self.persistent_log:
+            from logging.handlers import RotatingFileHandler
+
+            if not os.path.isdir(os.path.dirname(self.persistent_log)):
+                os.makedirs(os.path.dirname(self.persistent_log))
+
+            persistent_handler = RotatingFileHandler(self.persistent_log, maxBytes=self.persistent_log_max_bytes,
+                backupCount=self.persistent_log_backups)
+            persistent_handler.setFormatter(logging.Formatter(DISK_LOGGING_FORMAT))
+            logger.addHandler(persistent_handler)
+
         logger.setLevel(logging.DEBUG if self.debug else logging.INFO)
 
         # emit logging configuration
-        logger.debug("Logging configuration: debug=%s, log_file=%s", self.debug, self.log_file)
+        logger.debug("Logging configuration: debug=%s, log_file=%s, persistent_log=%s", self.debug, self.log_file,
+            self.persistent_log)
 
         return logger
 
     def setup_directories(self):
         """Create and manage directories critical to the degoss lifecycle."""
-        for directory in [self.bin_dir, self.log_dir]:
+        if self.resident and not os.path.isdir(self.resident_dir):
+            # the resident directory holds the variables, which may include secrets
+            os.makedirs(self.resident_dir, 0o0700)
+
+        for directory in [self.bin_dir, self.log_dir] + ([self.cache_dir] if self.cache_dir else []):
             if not os.path.isdir(directory):
                 os.makedirs(directory)
 
@@ -206,7 +946,8 @@ class Degoss(object):
     @property
     def failed(self):
         """Return whether the run failed."""
-        return self.has_run and self.failed_tests > 0
+        # a run which timed out or errored has no test counts
+        return self.has_run and (self.failed_tests or 0) > 0
 
     @property
     def passed(self):
@@ -233,11 +974,21 @@ class Degoss(object):
 
     def get_latest_version(self):
         """Detect and return the latest available version of Goss."""
+        if self.cache_dir and self.version_cache_ttl > 0:
+            version = self.load_cached_version()
+
+            if version:
+                self.logger.info("Using cached latest available Goss version %s", version)
+                return version
 
-        status, url, response = self.request("{}/releases/latest".format(REPO_URL))
+        if self.offline:
+            self.fail("Unable to determine latest Goss release in offline mode, pass a specific version instead")
+
+        with self.timed('install.version'):
+            status, url, response = self.request("{}/releases/latest".format(self.repo_url))
 
         if status != 200:
-            self.fail("Unable to determine latest Goss release, HTTP status %d".format(status))
+            self.fail("Unable to determine latest Goss release, HTTP status {}".format(status))
 
         # url will be something like https://github.com/aelsabbahy/goss/releases/tag/v0.3.6,
         # we will extract the tag from this url, then attempt to transform this into a version
@@ -247,8 +998,33 @@ class Degoss(object):
 
         self.logger.info("Detected latest available Goss version as %s", version)
 
+        if self.cache_dir and self.version_cache_ttl > 0:
+            self.save_cached_version(version)
+
         return version
 
+    def load_cached_version(self):
+        """Return the cached latest version of Goss if it has not expired, otherwise None."""
+        try:
+            with open(os.path.join(self.cache_dir, CACHE_VERSION_FILE), 'r') as f:
+                cached = json.load(f)
+
+            if time.time() - cached['resolved_at'] <= self.version_cache_ttl:
+                return cached['version']
+        except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+            self.logger.debug("No usable cached latest Goss version: %s", e)
+
+        return None
+
+    def save_cached_version(self, version):
+        """Atomically store the resolved latest version of Goss in the cache."""
+        fd, staged = tempfile.mkstemp(dir=self.cache_dir, prefix='.' + CACHE_VERSION_FILE + '.', suffix='.tmp')
+
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'version': version, 'resolved_at': time.time()}, f)
+
+        os.rename(staged, os.path.join(self.cache_dir, CACHE_VERSION_FILE))
+
     def get_bool(self, name, default=False):
         """Get a booleanish parameter from the module parameters."""
         param = self.module.params.get(name, default)
@@ -262,15 +1038,24 @@ class Degoss(object):
 
     def get_release_url(self):
         """Fetch the Goss binary URL."""
-        # regardless, return the release URL
-        return "{}/releases/download/v{}/goss-{}-{}".format(REPO_URL, self.version, self.os, self.arch)
+        if self.release_url:
+            return self.release_url.format(version=self.version, os=self.os, arch=self.arch)
+
+        return "{}/releases/download/v{}/goss-{}-{}".format(self.repo_url, self.version, self.os, self.arch)
 
-    def request(self, url, method='GET'):
+    def request(self, url, method='GET', headers=None):
         """Make an HTTP request to the given URL and return the response."""
+        if self.offline and not url.startswith('file://'):
+            self.fail("Refusing to request {} in offline mode".format(url))
+
+        from ansible.module_utils.six.moves.urllib.request import Request, urlopen
 
         r = Request(url)
         r.get_method = lambda: method
 
+        for name, value in (headers or {}).items():
+            r.add_header(name, value)
+
         response = urlopen(r)
         status, response_url = response.getcode(), response.geturl()
 
@@ -278,7 +1063,7 @@ class Degoss(object):
 
     def deserialize_dict(self, value):
         """Deserialize a value into a dictionary."""
-        if isinstance(value, string_types):
+        if isinstance(value, six.string_types):
             try:
                 # it's a string so try to deserialize it into a JSON dictionary.
                 result = json.loads(value)
@@ -300,21 +1085,47 @@ class Degoss(object):
     def execute(self):
         """Run the module."""
         try:
-            self.initialize()
-            self.install()
-            self.test()
+            with self.timed('initialize'):
+                self.initialize()
+
+            if self.resident:
+                with self.timed('test'):
+                    self.serve()
+            else:
+                with self.timed('install'):
+                    self.install()
+
+                with self.timed('test'):
+                    self.test()
         finally:
-            self.clean()
+            # log the timings while the log file still exists
+            self.logger.info("Phase timings: %s", ", ".join("{}={:.3f}s".format(name, seconds)
+                for name, seconds in self.timings.items()))
+
+            with self.timed('clean'):
+                self.clean()
 
         result = {
             'changed': False,
+            'download_bytes': self.download_bytes,
+            'download_seconds': self.download_seconds,
             'failures': self.failed_messages,
+            'files': self.file_results,
+            'result_detail': self.result_detail,
+            # the full result document is only left behind on the host when it was not cleaned up
+            'result_file': self.result_file if os.path.exists(self.result_file) else None,
+            'setup': self.setup,
             'test_result': self.test_result,
             'tests_failed': self.failed_tests,
-            'tests_passed': self.total_tests - self.failed_tests,
+            'tests_passed': self.total_tests - self.failed_tests - (self.skipped_tests or 0),
+            'tests_skipped': self.skipped_tests,
             'tests_total': self.total_tests,
+            'timings': self.timings,
         }
 
+        if self.baseline_diff:
+            result.update(self.baseline_diff.get_deltas())
+
         # if we have made it this far, there weren't any execution issues
         if self.failed:
             self.logger.info("Goss test(s) failed, %d of %d test(s) failed: %s%s", self.failed_tests, self.total_tests,
@@ -330,24 +1141,32 @@ class Degoss(object):
 
         self.module.exit_json(**result)
 
-    def install(self):
-        """Install the Goss binary."""
-        release_url = self.get_release_url()
-
-        self.logger.info("Installing the Goss binary from %s into %s", release_url, self.bin_dir)
+    @contextlib.contextmanager
+    def timed(self, name):
+        """Measure how long the block takes, accumulating the seconds in the timings under the given name."""
+        started = monotonic()
 
-        status, _, response = self.request(release_url)
+        try:
+            yield
+        finally:
+            self.timings[name] = round(self.timings.get(name, 0) + monotonic() - started, 6)
 
-        # write to a file
-        with open(self.executable, 'w') as f:
-            # buffered read at 8KiB chunks
-            chunk = response.read(BUFFER_SIZE)
+    def timed_call(self, name, function, *args, **kwargs):
+        """Call the function, measuring how long it takes under the given name, and return its result."""
+        with self.timed(name):
+            return function(*args, **kwargs)
 
-            while chunk:
-                f.write(chunk)
-                chunk = response.read(BUFFER_SIZE)
+    def install(self):
+        """Install the Goss binary."""
+        if self.binary_path:
+            self.place_binary()
+        elif self.cache_dir and self.timed_call('install.cache', self.load_cached_binary):
+            self.logger.info("Installed the Goss binary from the cache in %s", self.cache_dir)
+        else:
+            self.download()
 
-            response.close()
+            if self.cache_dir:
+                self.save_cached_binary()
 
         if self.os in ('linux', 'darwin'):
             # make it executable by the current user
@@ -355,84 +1174,1157 @@ class Degoss(object):
 
         self.logger.debug("Successfully installed the binary to %s", self.executable)
 
-    def test(self):
-        """Execute the test cases."""
-        # deserialize the facts; note that when passing in a dictionary from Ansible as an argument, it is serialized
-        # into JSON before passing into the module, therefore we may need to deserialize
-        self.logger.debug("Deserializing facts from JSON input")
-        self.facts = self.deserialize_dict(self.facts)
+    def place_binary(self):
+        """Place a Goss binary which is already on the host, e.g. pushed by the controller, into the temporary root."""
+        if not os.path.isfile(self.binary_path):
+            self.fail("Goss binary {} does not exist on the host".format(self.binary_path))
 
-        # ansible_facts strips the leading ansible_ prefix from variables, restore it to avoid collisions
-        for key in self.facts.keys():
-            if not key.startswith("ansible_"):
-                self.facts["ansible_{}".format(key)] = self.facts.pop(key)
+        self.logger.info("Installing the Goss binary from %s into %s", self.binary_path, self.bin_dir)
 
-        self.logger.debug("Deserializing variables from JSON input")
-        self.variables = self.deserialize_dict(self.variables)
+        if os.path.abspath(self.binary_path) != os.path.abspath(self.executable):
+            shutil.copyfile(self.binary_path, self.executable)
+
+    def download(self):
+        """Download the Goss binary into the temporary root, resuming interrupted transfers and verifying it."""
+        release_url = self.get_release_url()
+        partial = self.executable + '.part'
 
-        # merge variables together
-        goss_variables = {}
-        goss_variables.update(self.facts)
-        goss_variables.update(self.variables)
+        self.logger.info("Installing the Goss binary from %s into %s", release_url, self.bin_dir)
 
-        self.logger.debug("Variable names exposed to Goss: %s", goss_variables.keys())
+        # a connection cut short while reading the body raises IncompleteRead, and a stalled one socket.timeout, which
+        # is an OSError
+        from ansible.module_utils.six.moves.http_client import HTTPException
 
-        # execute the test cases, piping in variables to standard input to avoid storing them on disk
-        self.logger.info("Executing Goss test cases")
+        with self.timed('install.download'):
+            for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+                try:
+                    self.download_bytes += self.fetch(release_url, partial)
+                    break
+                except (IOError, OSError, HTTPException) as e:
+                    # client errors such as a missing release will not go away by retrying
+                    if attempt == DOWNLOAD_ATTEMPTS or 400 <= getattr(e, 'code', 0) < 500:
+                        self.fail("Unable to download Goss from {}: {}".format(release_url, e))
 
-        cli_arguments = [self.executable, '--gossfile', self.test_file, '--vars', '/dev/stdin', 'validate',
-            '--no-color', '--format', 'json']
+                    self.logger.warning("Download of %s interrupted (%s), resuming (attempt %d of %d)", release_url, e,
+                        attempt + 1, DOWNLOAD_ATTEMPTS)
 
-        self.logger.debug("Executing Goss as \"%s\" in %s; environment variables: %s", " ".join(cli_arguments),
-            self.test_dir, dict(os.environ))
+        self.download_seconds = self.timings['install.download']
 
-        p = subprocess.Popen(cli_arguments, cwd=self.test_dir, env=dict(os.environ), stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT, stdin=subprocess.PIPE)
+        self.logger.debug("Downloaded %d bytes in %.3fs", self.download_bytes, self.download_seconds)
 
-        stdout, _ = p.communicate(input=json.dumps(goss_variables))
+        with self.timed('install.verify'):
+            self.verify_download(release_url, partial)
 
-        self._has_run = True
+        # only ever expose a complete, verified binary at the executable path
+        os.rename(partial, self.executable)
+
+    def fetch(self, url, destination):
+        """Stream a URL to a file in binary mode, resuming from a partial file if present; returns bytes written."""
+        offset = os.path.getsize(destination) if os.path.exists(destination) else 0
 
         try:
-            result = json.loads(stdout)
+            status, _, response = self.request(url, headers={'Range': 'bytes={}-'.format(offset)} if offset else None)
+        except (IOError, OSError) as e:
+            if offset and getattr(e, 'code', None) == 416:
+                # the requested range starts at the end of the file, so the partial file is already complete
+                return 0
 
-            self.logger.debug("Writing Goss JSON test results to %s", self.result_file)
+            raise
 
-            with open(self.result_file, 'w') as f:
-                f.write(json.dumps(result, indent=2, sort_keys=True))
+        try:
+            # servers that do not support ranges send the entire file again
+            with open(destination, 'ab' if offset and status == 206 else 'wb') as f:
+                start = f.tell()
+                shutil.copyfileobj(response, f, BUFFER_SIZE)
 
-            self.logger.debug("Goss executed successfully, looking for failed test cases.")
+                return f.tell() - start
+        finally:
+            response.close()
 
-            self.test_result = result
-            self.total_tests = result.get('summary', {}).get('test-count', 0)
-            self.failed_tests = result.get('summary', {}).get('failed-count', 0)
+    def verify_download(self, release_url, path):
+        """Verify a downloaded binary against the explicit or published SHA-256 checksum, failing on mismatch."""
+        expected = self.checksum
 
-            if self.failed_tests > 0:
-                self.failed_messages = [
-                    case['summary-line'] for case in result['results'] if case['successful'] != True
-                ]
-        except Exception as e:
-            self._errored = True
+        if not expected and self.verify_checksum:
+            expected = self.get_published_checksum(release_url)
 
-            self.logger.error("Fatal Goss error (rc=%d): %s", p.returncode, e)
-            self.fail("Goss Execution Failed (Unable to run tests) (rc={})".format(p.returncode),
-                stdout_lines=stdout.split(os.linesep), rc=p.returncode)
+        if not expected:
+            self.logger.debug("Skipping checksum verification of %s", release_url)
+            return
 
-    def clean(self):
-        """Clean everything up."""
-        if self.do_clean and os.path.exists(self.tmp_root) and os.path.isdir(self.tmp_root):
-            if (self.failed or self.errored) and not self.clean_on_failure:
-                # when not clean_on_failure and errors/failures encountered, no-op
-                self.logger.info("Not cleaning because clean_on_failure is false and there were errors/failures.")
-                return
+        actual = sha256sum(path)
 
-            self.logger.info("Removing all traces of Goss from the system")
-            self.logger.debug("Recursively removing the temporary root directory %s", self.tmp_root)
-            shutil.rmtree(self.tmp_root)
-        elif not self.do_clean:
-            self.logger.info("Cleaning is disabled, taking no action to remove %s", self.tmp_root)
-        else:
-            self.logger.error("Unable to clean up: %s is not a directory on disk", self.tmp_root)
+        if actual != expected.lower():
+            os.remove(path)
+            self.fail("Checksum verification of {} failed, expected {} but got {}".format(release_url, expected,
+                actual))
+
+        self.logger.debug("Verified SHA-256 checksum %s of %s", actual, release_url)
+
+    def get_published_checksum(self, release_url):
+        """Return the SHA-256 checksum published alongside a release binary, or None if none is published."""
+        try:
+            _, _, response = self.request(release_url + CHECKSUM_SUFFIX)
+
+            try:
+                content = response.read().decode('utf-8')
+            finally:
+                response.close()
+        except (IOError, OSError) as e:
+            self.logger.warning("No published checksum available for %s (%s), skipping verification", release_url, e)
+            return None
+
+        # published as "<hex digest>  <filename>"
+        return content.split()[0] if content.strip() else None
+
+    def get_cache_paths(self):
+        """Return the cached binary path and its checksum path for the current version, os, and arch."""
+        binary = os.path.join(self.cache_dir, "goss-{}-{}-{}".format(self.version, self.os, self.arch))
+
+        return binary, binary + CHECKSUM_SUFFIX
+
+    @contextlib.contextmanager
+    def cache_lock(self, exclusive=False):
+        """Hold a lock on the binary cache, shared for readers and exclusive for writers."""
+        with open(os.path.join(self.cache_dir, CACHE_LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+            try:
+                yield
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    def load_cached_binary(self):
+        """Copy a cached Goss binary into place if present and valid, returning whether the cache was hit."""
+        binary, checksum_file = self.get_cache_paths()
+
+        with self.cache_lock():
+            if not os.path.isfile(binary) or not os.path.isfile(checksum_file):
+                self.logger.debug("No cached Goss binary found at %s", binary)
+                return False
+
+            with open(checksum_file, 'r') as f:
+                expected = f.read().strip()
+
+            shutil.copyfile(binary, self.executable)
+
+            # refresh the modification time so that eviction is least recently used
+            os.utime(binary, None)
+
+        # verify the copy that will actually be executed, not the shared one
+        actual = sha256sum(self.executable)
+
+        if actual != expected:
+            self.logger.warning("Cached Goss binary %s failed checksum verification (expected %s, got %s), evicting it",
+                binary, expected, actual)
+
+            with self.cache_lock(exclusive=True):
+                self.remove_cache_entry(binary)
+
+            return False
+
+        return True
+
+    def save_cached_binary(self):
+        """Atomically store the freshly downloaded Goss binary in the cache and evict stale entries."""
+        binary, checksum_file = self.get_cache_paths()
+        prefix = ".{}.".format(os.path.basename(binary))
+
+        # stage both files under temporary names in the cache directory so the renames are atomic
+        fd, staged_binary = tempfile.mkstemp(dir=self.cache_dir, prefix=prefix, suffix='.tmp')
+        os.close(fd)
+        shutil.copyfile(self.executable, staged_binary)
+
+        fd, staged_checksum = tempfile.mkstemp(dir=self.cache_dir, prefix=prefix, suffix='.tmp')
+
+        with os.fdopen(fd, 'w') as f:
+            f.write(sha256sum(staged_binary))
+
+        with self.cache_lock(exclusive=True):
+            os.rename(staged_checksum, checksum_file)
+            os.rename(staged_binary, binary)
+
+            self.evict_cache(keep=binary)
+
+        self.logger.debug("Saved the Goss binary to the cache at %s", binary)
+
+    def evict_cache(self, keep=None):
+        """Evict expired cache entries, then the least recently used ones until the cache fits its size bound."""
+        now, entries = time.time(), []
+
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+
+            if name.startswith('.') and name.endswith('.tmp'):
+                # staged files left behind by interrupted runs
+                if now - os.stat(path).st_mtime > CACHE_TEMP_MAX_AGE:
+                    os.remove(path)
+
+                continue
+
+            if not name.startswith('goss-') or name.endswith(CHECKSUM_SUFFIX) or path == keep:
+                continue
+
+            st = os.stat(path)
+
+            if self.cache_max_age > 0 and now - st.st_mtime > self.cache_max_age:
+                self.logger.debug("Evicting expired cached Goss binary %s", path)
+                self.remove_cache_entry(path)
+            else:
+                entries.append((st.st_mtime, st.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries) + (os.stat(keep).st_size if keep else 0)
+
+        for _, size, path in sorted(entries):
+            if self.cache_max_size <= 0 or total_size <= self.cache_max_size:
+                break
+
+            self.logger.debug("Evicting least recently used cached Goss binary %s", path)
+            self.remove_cache_entry(path)
+            total_size -= size
+
+    def remove_cache_entry(self, binary):
+        """Remove a cached binary and its checksum; the caller must hold the exclusive cache lock."""
+        for path in (binary, binary + CHECKSUM_SUFFIX):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test(self):
+        """Execute the test cases."""
+        # AnsibleModule already parses dict arguments, so this only parses values which still arrive as JSON strings
+        self.facts = self.deserialize_dict(self.facts)
+        self.variables = self.deserialize_dict(self.variables)
+
+        self.logger.debug("Exposing %d fact(s) and %d variable(s) to Goss", len(self.facts), len(self.variables))
+
+        # serialize the variables once and share them across every Goss execution, unless they are streamed
+        with self.timed('test.variables'):
+            payload = None if self.stream_variables else json.dumps(dict(self.iter_variables())).encode('utf-8')
+
+        test_files, deferred = self.get_test_files(), None
+
+        if self.render_cache and self.cache_dir:
+            with self.timed('test.render'):
+                test_files = self.load_rendered(test_files, payload)
+
+            if test_files is None:
+                return
+        elif self.render_cache:
+            self.logger.warning("Not caching rendered test files because cache_dir is not set")
+
+        if self.selecting:
+            with self.timed('test.select'):
+                test_files, deferred = self.select_tests(test_files, payload)
+
+            if test_files is None:
+                return
+
+        self.logger.info("Executing Goss test cases from %d file(s)", len(test_files))
+
+        if self.timeout:
+            self.deadline = time.time() + self.timeout
+
+        while True:
+            self.baseline_diff = self.load_baseline()
+
+            if self.stream_results:
+                self.result_writer = ResultWriter(self.result_file)
+
+            results = self.run_tests(test_files, payload)
+
+            if results is None:
+                return
+
+            if deferred and not any(document.get('summary', {}).get('failed-count', 0) for _, document in results):
+                # the previously failed tests pass now, so run the rest
+                self.logger.info("Previously failed tests passed, executing the remaining tests")
+
+                if self.result_writer:
+                    self.result_writer.close()
+
+                test_files, deferred = deferred, None
+                continue
+
+            break
+
+        self.collect_results(results)
+
+    def run_tests(self, test_files, payload):
+        """Run Goss against the test files concurrently and parse the results, or fail and return None."""
+        with self.timed('test.goss'):
+            if len(test_files) == 1:
+                runs = [self.run_goss(test_files[0], payload)]
+            else:
+                # goss spends its time waiting on the host, so threads driving subprocesses parallelize fine
+                from multiprocessing.pool import ThreadPool
+
+                pool = ThreadPool(min(self.workers, len(test_files)))
+
+                try:
+                    runs = pool.map(lambda test_file: self.run_goss(test_file, payload), test_files)
+                finally:
+                    pool.close()
+                    pool.join()
+
+        self._has_run = True
+
+        if self.timed_out_files:
+            self._errored = True
+
+            if self.result_writer:
+                self.result_writer.close()
+
+            self.logger.error("Goss did not finish within %ds, killed it while running %s", self.timeout,
+                ", ".join(self.timed_out_files))
+            self.fail("Goss Execution Timed Out (after {}s)".format(self.timeout), timed_out=True,
+                timed_out_files=self.timed_out_files, timeout=self.timeout)
+
+            return None
+
+        results = []
+
+        for test_file, returncode, stdout in runs:
+            try:
+                with self.timed('test.parse'):
+                    results.append((test_file, stdout if isinstance(stdout, dict) else json.loads(stdout)))
+            except Exception as e:
+                self._errored = True
+
+                if self.result_writer:
+                    self.result_writer.close()
+
+                self.logger.error("Fatal Goss error in %s (rc=%d): %s", test_file, returncode, e)
+                self.fail("Goss Execution Failed (Unable to run tests) (rc={})".format(returncode),
+                    stdout_lines=stdout.split(os.linesep), rc=returncode)
+
+                return None
+
+        return results
+
+    @property
+    def selecting(self):
+        """Return whether only some of the tests are selected to run."""
+        return self.select != 'all' or bool(self.resource_types) or bool(self.tags)
+
+    def select_tests(self, test_files, payload):
+        """
+        Render each test file with Goss, marking every resource which is not selected to be skipped by Goss.
+
+        Returns the rendered test files to run and, in failed_first mode, the rendered test files to run once the
+        previously failed tests pass, or None for both after failing.
+        """
+        failed = self.load_failed() if self.select != 'all' else None
+
+        if failed is None and self.select != 'all':
+            self.logger.info("No record of previously failed tests in %s, executing all selected tests", self.state_dir)
+
+        selected_dir = os.path.join(self.tmp_root, 'selected')
+
+        if not os.path.isdir(selected_dir):
+            os.makedirs(selected_dir)
+
+        selected, deferred = [], [] if failed is not None and self.select == 'failed_first' else None
+        self.selected_resources = set()
+
+        for index, test_file in enumerate(test_files):
+            if test_file in self.selected_names:
+                # already rendered into the cache
+                with open(test_file, 'r') as f:
+                    document = self.parse_rendered(unescape_template(f.read()))
+            else:
+                rendered = self.render_goss(test_file, payload)
+                document = None if rendered is None else self.parse_rendered(rendered)
+
+            if document is None:
+                return None, None
+
+            if deferred is not None:
+                # the second pass runs everything else which is selected
+                deferred.append(self.write_selection(document, None, test_file,
+                    os.path.join(selected_dir, "{}.all.json".format(index))))
+
+            selected.append(self.write_selection(document, failed, test_file,
+                os.path.join(selected_dir, "{}.json".format(index))))
+
+        self.logger.info("Selected %d resource(s) to test", len(self.selected_resources))
+
+        return selected, deferred
+
+    def write_selection(self, document, failed, test_file, path):
+        """Write a rendered test document with only the selected resources enabled, returning its path."""
+        self.selected_resources.update(self.mark_skipped(document, failed))
+        self.selected_names[path] = self.selected_names.get(test_file, test_file)
+
+        with open(path, 'w') as f:
+            f.write(escape_template(json.dumps(document)))
+
+        return path
+
+    def load_rendered(self, test_files, payload):
+        """
+        Return the cached renders of the test files, rendering those which are not cached yet, or None after failing.
+
+        Renders are keyed by everything Goss renders them from, so that a change to any of them renders them again.
+        """
+        render_dir = os.path.join(self.cache_dir, RENDER_CACHE_DIR)
+
+        if not os.path.isdir(render_dir):
+            # rendered test files contain the values of the variables, which may include secrets
+            os.makedirs(render_dir, 0o0700)
+
+        digest, rendered, hits = hashlib.sha256(), [], 0
+
+        for value in (self.version, self.get_tests_digest(), self.get_variables_digest()):
+            digest.update(value.encode('utf-8') + b'\0')
+
+        for test_file in test_files:
+            key = digest.copy()
+            key.update(test_file.encode('utf-8'))
+
+            # goss reads test files in the format named by their extension, which it also renders them in
+            path = os.path.join(render_dir, key.hexdigest() + os.path.splitext(test_file)[1])
+
+            if os.path.isfile(path):
+                # refresh the modification time so that eviction only removes unused renders
+                os.utime(path, None)
+                hits += 1
+            else:
+                output = self.render_goss(test_file, payload)
+
+                if output is None:
+                    return None
+
+                # values such as a docker --format argument must not be templated again when validating
+                self.write_private(path, escape_template(output).encode('utf-8'))
+
+            self.selected_names[path] = test_file
+            rendered.append(path)
+
+        self.logger.info("Reused %d of %d rendered test file(s) from %s", hits, len(test_files), render_dir)
+        self.evict_rendered(render_dir)
+
+        return rendered
+
+    def evict_rendered(self, render_dir):
+        """Remove rendered test files which have not been used within the maximum cache age."""
+        if self.cache_max_age <= 0:
+            return
+
+        now = time.time()
+
+        for name in os.listdir(render_dir):
+            path = os.path.join(render_dir, name)
+
+            try:
+                if now - os.stat(path).st_mtime > self.cache_max_age:
+                    self.logger.debug("Evicting expired rendered test file %s", path)
+                    os.remove(path)
+            except OSError:
+                # removed by a concurrent run
+                pass
+
+    def render_goss(self, test_file, payload):
+        """Render a test file with Goss, resolving templates and included test files, and return the output."""
+        if payload is None:
+            payload = json.dumps(dict(self.iter_variables())).encode('utf-8')
+
+        p = subprocess.Popen([self.executable, '--gossfile', test_file, '--vars', '/dev/stdin', 'render'],
+            cwd=self.test_dir, env=dict(os.environ), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            stdin=subprocess.PIPE)
+        stdout, stderr = p.communicate(input=payload)
+        stdout = stdout.decode('utf-8', 'replace')
+
+        if p.returncode != 0:
+            self._errored = True
+            self.logger.error("Unable to render %s (rc=%d): %s", test_file, p.returncode, stderr)
+            self.fail("Goss Render Failed (rc={})".format(p.returncode), rc=p.returncode,
+                stdout_lines=(stdout + stderr.decode('utf-8', 'replace')).split(os.linesep))
+
+            return None
+
+        return stdout
+
+    def parse_rendered(self, output):
+        """Parse a test file rendered by Goss, or return None after failing."""
+        try:
+            # goss renders in the format of the test file, so JSON needs no YAML parser
+            return json.loads(output)
+        except ValueError:
+            pass
+
+        try:
+            import yaml
+        except ImportError:
+            self._errored = True
+            self.fail(missing_required_lib('PyYAML', reason='selecting tests from YAML test files'))
+
+            return None
+
+        return yaml.safe_load(output) or {}
+
+    def mark_skipped(self, document, failed):
+        """
+        Mark resources in a rendered test document to be skipped unless they are selected by resource type and tag, and
+        by having previously failed, if given. Returns the keys of the selected resources.
+        """
+        types, tags, selected = set(normalize_type(kind) for kind in self.resource_types), set(self.tags), set()
+
+        for kind, resources in document.items():
+            if not isinstance(resources, dict):
+                continue
+
+            for resource_id, attributes in resources.items():
+                if not isinstance(attributes, dict):
+                    continue
+
+                key = (normalize_type(kind), resource_id)
+                meta = attributes.get('meta') or {}
+                resource_tags = (meta.get('tags') or []) if isinstance(meta, dict) else []
+
+                if isinstance(resource_tags, six.string_types):
+                    resource_tags = [resource_tags]
+
+                if (not types or key[0] in types) and (not tags or tags.intersection(resource_tags)) and \
+                        (failed is None or key in failed):
+                    attributes.pop('skip', None)
+                    selected.add(key)
+                else:
+                    attributes['skip'] = True
+
+        return selected
+
+    def load_failed(self):
+        """Load the resources which failed in the previous run of the same test files, or None if unknown."""
+        if not self.state_dir:
+            return None
+
+        try:
+            with open(os.path.join(self.state_dir, STATE_FAILED_FILE), 'r') as f:
+                record = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if record.get('test_files') != self.test_files:
+            return None
+
+        return set((kind, resource_id) for kind, resource_id in record.get('failed', []))
+
+    def save_failed(self, failures):
+        """Record the resources which failed, keeping those which failed before and were not run this time."""
+        failed = set((normalize_type(case.get('resource-type', '')), case.get('resource-id')) for case in failures
+            if not case.get('skipped'))
+
+        if self.selected_resources is not None:
+            failed.update(key for key in (self.load_failed() or set()) if key not in self.selected_resources)
+
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+
+        self.write_private(os.path.join(self.state_dir, STATE_FAILED_FILE), json.dumps({
+            'failed': sorted(failed),
+            'test_files': self.test_files,
+        }).encode('utf-8'))
+
+    def load_baseline(self):
+        """Start diffing against the outcome of each check in the previous run, if baseline is enabled."""
+        if not self.baseline:
+            return None
+
+        if not self.state_dir:
+            self.logger.warning("Not diffing against a baseline because state_dir is not set")
+            return None
+
+        try:
+            with open(os.path.join(self.state_dir, STATE_BASELINE_FILE), 'r') as f:
+                record = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            self.logger.info("No baseline to diff against in %s: %s", self.state_dir, e)
+            return BaselineDiff(None)
+
+        if record.get('test_files') != self.test_files:
+            # the checks of other test files are not comparable, so this counts as the first run
+            self.logger.info("Not diffing against the baseline in %s, which is of other test files", self.state_dir)
+            return BaselineDiff(None)
+
+        return BaselineDiff(record.get('checks', {}))
+
+    def save_baseline(self, result):
+        """Diff the results against the baseline, unless they were as they arrived, and replace the baseline."""
+        if not self.result_writer:
+            for case in (result.get('results') or []):
+                self.baseline_diff.add(case)
+
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+
+        self.write_private(os.path.join(self.state_dir, STATE_BASELINE_FILE), json.dumps({
+            'checks': self.baseline_diff.current,
+            'test_files': self.test_files,
+        }, separators=(',', ':'), sort_keys=True).encode('utf-8'))
+
+        if self.baseline_diff.previous is None:
+            return
+
+        self.logger.info("Compared to the baseline, %d check(s) newly failed, %d newly passed, and %d are unchanged",
+            len(self.baseline_diff.newly_failed), len(self.baseline_diff.newly_passed),
+            self.baseline_diff.unchanged_count)
+
+    def collect_results(self, results):
+        """Merge, write, and count the parsed Goss result documents of each test file."""
+        result = results[0][1] if len(results) == 1 else self.merge_results(results)
+
+        with self.timed('test.write'):
+            if self.result_writer:
+                # results have already been written as they were produced
+                self.result_writer.close(result.get('summary'))
+            else:
+                self.logger.debug("Writing Goss JSON test results to %s", self.result_file)
+
+                with open_result(self.result_file) as f:
+                    f.write(json.dumps(result, separators=(',', ':')))
+
+        self.logger.debug("Goss executed successfully, looking for failed test cases.")
+
+        self.test_result = self.reduce_result(result)
+        self.total_tests = result.get('summary', {}).get('test-count', 0)
+        self.failed_tests = result.get('summary', {}).get('failed-count', 0)
+        self.skipped_tests = self.count_skipped(results[0][0], result) if len(results) == 1 else \
+            result['summary']['skipped-count']
+
+        self.file_results = dict(
+            (self.selected_names.get(test_file, test_file), {
+                'tests_failed': document.get('summary', {}).get('failed-count', 0),
+                'tests_skipped': self.count_skipped(test_file, document),
+                'tests_total': document.get('summary', {}).get('test-count', 0),
+            }) for test_file, document in results
+        )
+
+        if self.state_dir:
+            self.save_failed([case for case in (result.get('results') or []) if not case.get('successful')])
+
+        if self.baseline_diff:
+            with self.timed('test.diff'):
+                self.save_baseline(result)
+
+        if self.failed_tests > 0 and self.result_detail != 'summary':
+            self.failed_messages = [
+                case['summary-line'] for case in (result.get('results') or []) if case['successful'] != True
+            ]
+
+    def count_skipped(self, test_file, document):
+        """Return the number of skipped results in the Goss result document of a test file, which Goss may not count."""
+        if 'skipped-count' in document.get('summary', {}):
+            return document['summary']['skipped-count']
+
+        if test_file in self.streamed_skipped:
+            return self.streamed_skipped[test_file]
+
+        return len([case for case in (document.get('results') or []) if case.get('skipped')])
+
+    def reduce_result(self, result):
+        """Reduce the Goss result document to the level of detail which is returned from the module."""
+        if self.result_detail == 'summary':
+            return {'summary': result.get('summary', {})}
+
+        if self.result_detail == 'failures_only':
+            return {
+                'results': [case for case in (result.get('results') or []) if not case.get('successful')],
+                'summary': result.get('summary', {}),
+            }
+
+        return result
+
+    def serve(self):
+        """Validate against the resident Goss server, starting it when its binary, tests, or variables changed."""
+        self.facts = self.deserialize_dict(self.facts)
+        self.variables = self.deserialize_dict(self.variables)
+
+        with self.timed('test.variables'):
+            payload = json.dumps(dict(self.iter_variables()), sort_keys=True).encode('utf-8')
+
+        digest, state = self.get_resident_digest(payload), self.load_resident_state()
+        reused = state.get('digest') == digest and self.is_resident(state.get('pid'))
+
+        if reused:
+            self.logger.info("Reusing the resident Goss server (pid %d) on port %d", state['pid'], state['port'])
+        else:
+            with self.timed('test.start'):
+                state = self.start_resident(state, digest, payload)
+
+        with self.timed('test.goss'):
+            document = self.query_resident(state['port'], reused)
+
+        if document is None and reused and not self._errored:
+            self.logger.warning("The resident Goss server (pid %d) did not respond, restarting it", state['pid'])
+
+            with self.timed('test.start'):
+                state = self.start_resident(state, digest, payload)
+
+            with self.timed('test.goss'):
+                document = self.query_resident(state['port'])
+
+        self._has_run = True
+
+        if document is None:
+            return
+
+        test_files = self.get_test_files()
+        self.baseline_diff = self.load_baseline()
+        self.collect_results([(test_files[0] if len(test_files) == 1 else RESIDENT_GOSSFILE, document)])
+
+    def get_resident_digest(self, payload):
+        """Hash everything which the resident Goss server was started with."""
+        digest = hashlib.sha256()
+
+        for value in [self.version, payload.decode('utf-8'), self.get_tests_digest()] + self.get_test_files() + \
+                self.get_goss_flags(serve=True):
+            digest.update(value.encode('utf-8') + b'\0')
+
+        return digest.hexdigest()
+
+    def get_tests_digest(self):
+        """Hash the relative paths and contents of every file in the test directory."""
+        if self.bundle:
+            # the bundle is unpacked into a directory named after the hash of its contents
+            return os.path.basename(self.test_dir)
+
+        digest = hashlib.sha256()
+
+        for root, dirs, files in os.walk(self.test_dir):
+            dirs.sort()
+
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                digest.update(os.path.relpath(path, self.test_dir).encode('utf-8') + b'\0')
+                digest.update(sha256sum(path).encode('utf-8'))
+
+        return digest.hexdigest()
+
+    def get_variables_digest(self):
+        """Hash the variables exposed to Goss independently of their order, one variable at a time."""
+        digest, encoder = hashlib.sha256(), json.JSONEncoder(sort_keys=True)
+
+        for name, value in sorted(self.iter_variables(), key=lambda item: item[0]):
+            digest.update(encoder.encode(name).encode('utf-8') + b':')
+            digest.update(encoder.encode(value).encode('utf-8') + b'\0')
+
+        return digest.hexdigest()
+
+    def load_resident_state(self):
+        """Load the state of the resident Goss server, if any."""
+        try:
+            with open(os.path.join(self.resident_dir, RESIDENT_STATE_FILE), 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def is_resident(self, pid):
+        """
+        Return whether the process with the given pid is the resident Goss server, rather than an unrelated process
+        which was given the pid of a server which has since exited, e.g. after a reboot.
+        """
+        if not pid:
+            return False
+
+        try:
+            with open('/proc/{}/cmdline'.format(pid), 'rb') as f:
+                arguments = f.read().decode('utf-8', 'replace').split('\0')
+        except (IOError, OSError):
+            # not every platform has /proc, where ps lists the arguments separated by spaces instead
+            try:
+                arguments = subprocess.check_output(['ps', '-o', 'args=', '-p', str(pid)],
+                    stderr=subprocess.STDOUT).decode('utf-8', 'replace').split()
+            except (OSError, subprocess.CalledProcessError):
+                return False
+
+        # the executable follows the interpreter when it is a script
+        return self.executable in arguments[:2] and 'serve' in arguments
+
+    def start_resident(self, state, digest, payload):
+        """(Re)start the resident Goss server with the current binary, tests, and variables, returning its state."""
+        if self.is_resident(state.get('pid')):
+            self.logger.info("Stopping the outdated resident Goss server (pid %d)", state['pid'])
+
+            try:
+                # goss was started in its own session, so its process group id is its pid
+                os.killpg(state['pid'], signal.SIGTERM)
+            except OSError as e:
+                self.logger.debug("Unable to stop the resident Goss server: %s", e)
+
+        if state.get('version') != self.version or not os.path.isfile(self.executable):
+            with self.timed('install'):
+                self.install()
+
+        test_dir, vars_file = os.path.join(self.resident_dir, 'tests'), os.path.join(self.resident_dir, 'vars.json')
+
+        if os.path.isdir(test_dir):
+            shutil.rmtree(test_dir)
+
+        shutil.copytree(self.test_dir, test_dir)
+        self.write_private(vars_file, payload)
+
+        test_files = self.get_test_files()
+
+        if len(test_files) == 1:
+            gossfile = test_files[0]
+        else:
+            # goss serve takes a single gossfile, so include all test files from one
+            gossfile = RESIDENT_GOSSFILE
+
+            with open(os.path.join(test_dir, gossfile), 'w') as f:
+                f.write(json.dumps({'gossfile': dict((test_file, {}) for test_file in test_files)}))
+
+        port = self.resident_port or self.get_free_port()
+        popen_kwargs = {'start_new_session': True} if six.PY3 else {'preexec_fn': os.setsid}
+
+        with open(os.devnull, 'rb') as devnull, open(os.path.join(self.resident_dir, 'goss.log'), 'ab') as log:
+            self.resident_process = subprocess.Popen([self.executable, '--gossfile', gossfile, '--vars', vars_file,
+                'serve', '--listen-addr', '127.0.0.1:{}'.format(port), '--format', 'json', '--cache',
+                RESIDENT_CACHE_TTL] + self.get_goss_flags(serve=True), cwd=test_dir, stdin=devnull, stdout=log,
+                stderr=subprocess.STDOUT, close_fds=True, **popen_kwargs)
+
+        self.logger.info("Started the resident Goss server (pid %d) on port %d", self.resident_process.pid, port)
+
+        state = {'digest': digest, 'pid': self.resident_process.pid, 'port': port, 'version': self.version}
+        self.write_private(os.path.join(self.resident_dir, RESIDENT_STATE_FILE), json.dumps(state).encode('utf-8'))
+
+        return state
+
+    def get_free_port(self):
+        """Return a local port which is currently free."""
+        import socket
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        try:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+        finally:
+            sock.close()
+
+    def write_private(self, path, data):
+        """Atomically write data to a file which only the current user can read."""
+        # mkstemp creates the file with mode 0600 under a unique name, so concurrent writers do not clobber each other
+        fd, staged = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path) + '.',
+            suffix='.tmp')
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+
+            os.rename(staged, path)
+        except Exception:
+            os.remove(staged)
+            raise
+
+    def query_resident(self, port, reused=False):
+        """
+        Run the tests through the resident Goss server, waiting for it to come up, and return the result document.
+
+        A reused server is already up, so if it is unreachable, None is returned right away for it to be restarted.
+        """
+        from ansible.module_utils.six.moves.urllib.error import HTTPError, URLError
+        from ansible.module_utils.six.moves.urllib.request import Request, urlopen
+        import socket
+
+        url = "http://127.0.0.1:{}/healthz".format(port)
+        deadline = monotonic() + (self.timeout or RESIDENT_START_TIMEOUT)
+
+        while True:
+            try:
+                body = urlopen(Request(url), timeout=self.timeout or None).read()
+                break
+            except HTTPError as e:
+                # goss responds with 503 when tests fail
+                body = e.read()
+                break
+            except (URLError, socket.error) as e:
+                if reused:
+                    self.logger.debug("Unable to reach the reused resident Goss server on port %d: %s", port, e)
+                    return None
+
+                exited = self.resident_process and self.resident_process.poll() is not None
+
+                if exited or monotonic() > deadline:
+                    self._errored = True
+                    self.logger.error("Unable to reach the resident Goss server on port %d: %s", port, e)
+                    self.fail("Resident Goss Server Unavailable (port {})".format(port), port=port)
+
+                    return None
+
+                time.sleep(RESIDENT_POLL_INTERVAL)
+
+        try:
+            return json.loads(body.decode('utf-8'))
+        except ValueError as e:
+            self._errored = True
+            self.logger.error("Fatal Goss error from the resident Goss server: %s", e)
+            self.fail("Goss Execution Failed (Unable to run tests)",
+                stdout_lines=body.decode('utf-8', 'replace').split(os.linesep))
+
+            return None
+
+    def get_test_files(self):
+        """Resolve the test file entries, which may be glob patterns relative to the test directory."""
+        test_files = []
+
+        for entry in self.test_files:
+            if GLOB_MATCHER.search(entry):
+                import glob
+
+                matches = sorted(os.path.relpath(path, self.test_dir)
+                    for path in glob.glob(os.path.join(self.test_dir, entry)))
+
+                if not matches:
+                    self.logger.warning("Test file pattern %s did not match any files in %s", entry, self.test_dir)
+            else:
+                # plain test files are deployed to the root of the test directory
+                matches = [entry.split(os.sep)[-1]]
+
+            test_files.extend(match for match in matches if match not in test_files)
+
+        if not test_files:
+            self.fail("No Goss test files found in {} matching {}".format(self.test_dir, ", ".join(self.test_files)))
+
+        return test_files
+
+    def run_goss(self, test_file, payload):
+        """Run Goss against a single test file, returning the test file, the return code, and the output."""
+        # execute the test cases, piping in variables to standard input to avoid storing them on disk
+        cli_arguments = [self.executable, '--gossfile', test_file, '--vars', '/dev/stdin', 'validate',
+            '--no-color', '--format', 'json'] + self.get_goss_flags()
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            # only pay for formatting the environment when it is logged
+            self.logger.debug("Executing Goss as \"%s\" in %s; environment variables: %s", " ".join(cli_arguments),
+                self.test_dir, dict(os.environ))
+
+        popen_kwargs, timer = {}, None
+
+        if self.deadline:
+            # run goss in its own process group so that the entire process tree can be killed on timeout
+            if six.PY3:
+                popen_kwargs['start_new_session'] = True
+            else:
+                popen_kwargs['preexec_fn'] = os.setsid
+
+        p = subprocess.Popen(cli_arguments, cwd=self.test_dir, env=dict(os.environ), stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, stdin=subprocess.PIPE, **popen_kwargs)
+
+        if self.deadline:
+            timer = threading.Timer(max(0, self.deadline - time.time()), self.kill_goss, args=(p, test_file))
+            timer.daemon = True
+            timer.start()
+
+        try:
+            if payload is None or self.stream_results:
+                # write standard input from another thread while standard output is being consumed
+                feeder = threading.Thread(target=self.write_variables, args=(p.stdin, payload))
+                feeder.daemon = True
+                feeder.start()
+
+                stdout = self.read_results(p.stdout, test_file) if self.stream_results else p.stdout.read()
+                p.stdout.close()
+                p.wait()
+                feeder.join()
+            else:
+                stdout, _ = p.communicate(input=payload)
+        finally:
+            if timer:
+                timer.cancel()
+
+        if isinstance(stdout, bytes):
+            stdout = stdout.decode('utf-8', 'replace')
+
+        return test_file, p.returncode, stdout
+
+    def iter_variables(self):
+        """Yield the variables exposed to Goss in a single pass, with user variables taking precedence over facts."""
+        for key, value in self.facts.items():
+            # ansible_facts strips the leading ansible_ prefix from variables, restore it to avoid collisions
+            name = key if key.startswith('ansible_') else 'ansible_' + key
+
+            if name not in self.variables:
+                yield name, value
+
+        for name, value in self.variables.items():
+            yield name, value
+
+    def write_variables(self, stream, payload=None):
+        """Write the serialized payload, or stream the variables exposed to Goss as JSON, then close the stream."""
+        encoder, chunks, size, separator = json.JSONEncoder(), ['{'], 0, ''
+
+        try:
+            if payload is not None:
+                stream.write(payload)
+                return
+
+            for name, value in self.iter_variables():
+                # encoding whole values uses the C encoder, so memory is bounded by the largest single variable
+                encoded = encoder.encode(value)
+                chunks.extend((separator, encoder.encode(name), ':', encoded))
+                size, separator = size + len(encoded), ','
+
+                # batch small variables into larger writes
+                if size > BUFFER_SIZE:
+                    stream.write(''.join(chunks).encode('utf-8'))
+                    chunks, size = [], 0
+
+            chunks.append('}')
+            stream.write(''.join(chunks).encode('utf-8'))
+        except (IOError, OSError) as e:
+            # goss exited without reading all of its input, its output will say why
+            self.logger.debug("Goss stopped reading variables: %s", e)
+        finally:
+            try:
+                stream.close()
+            except (IOError, OSError):
+                pass
+
+    def read_results(self, stream, test_file):
+        """
+        Parse Goss output incrementally, writing each result to disk as it arrives.
+
+        Returns a result document holding only the failed results, none if only the summary is returned, and the summary,
+        or the captured output if it was not a Goss result document.
+        """
+        failures, captured, captured_size, skipped = [], [], 0, [0]
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+        def on_result(result):
+            self.result_writer.write(result)
+
+            if self.baseline_diff:
+                self.baseline_diff.add(result)
+
+            if result.get('skipped'):
+                skipped[0] += 1
+
+            # only failures are returned, and not even those when only returning the summary unless they are recorded
+            if not result.get('successful') and (self.result_detail != 'summary' or self.state_dir):
+                failures.append(result)
+
+        parser = ResultStreamParser(on_result)
+        chunk = os.read(stream.fileno(), BUFFER_SIZE)
+
+        while chunk:
+            text = decoder.decode(chunk)
+            parser.feed(text)
+
+            # keep the beginning of the output to report when it turns out not to be a result document
+            if captured_size < CAPTURED_OUTPUT_LIMIT:
+                captured.append(text)
+                captured_size += len(text)
+
+            chunk = os.read(stream.fileno(), BUFFER_SIZE)
+
+        if not parser.complete:
+            self.logger.error("Goss output for %s was not a complete result document", test_file)
+            return ''.join(captured)
+
+        parser.document['results'] = failures
+        # the results which were skipped can no longer be counted from the document
+        self.streamed_skipped[test_file] = skipped[0]
+
+        return parser.document
+
+    def get_goss_flags(self, serve=False):
+        """Build the optional Goss validate, or serve, flags from the module parameters."""
+        flags = []
+
+        if self.max_concurrent:
+            flags.extend(['--max-concurrent', str(self.max_concurrent)])
+
+        if serve:
+            # retrying is only supported by validate
+            return flags
+
+        if self.retry_timeout:
+            flags.extend(['--retry-timeout', self.retry_timeout])
+
+        if self.sleep:
+            flags.extend(['--sleep', self.sleep])
+
+        return flags
+
+    def kill_goss(self, process, test_file):
+        """Kill a Goss process and all of its children after the deadline has passed."""
+        if process.poll() is not None:
+            # it finished just as the deadline passed
+            return
+
+        self.timed_out_files.append(test_file)
+
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError as e:
+            # the process exited in the meantime
+            self.logger.debug("Unable to kill Goss process group %d: %s", process.pid, e)
+
+    def merge_results(self, results):
+        """Merge the Goss results of multiple test files into a single Goss result document."""
+        merged = {'results': []}
+        summary = {'failed-count': 0, 'skipped-count': 0, 'test-count': 0, 'total-duration': 0}
+
+        for test_file, document in results:
+            # goss reports no results at all as null
+            merged['results'].extend(document.get('results') or [])
+            summary['skipped-count'] += self.count_skipped(test_file, document)
+
+            for key in ('failed-count', 'test-count'):
+                summary[key] += document.get('summary', {}).get(key, 0)
+
+            # test files run concurrently, so the slowest one determines the duration
+            summary['total-duration'] = max(summary['total-duration'],
+                document.get('summary', {}).get('total-duration', 0))
+
+        summary['summary-line'] = "Count: {}, Failed: {}, Skipped: {}, Duration: {:.3f}s".format(
+            summary['test-count'], summary['failed-count'], summary['skipped-count'], summary['total-duration'] / 1e9)
+
+        merged['summary'] = summary
+
+        return merged
+
+    def clean(self):
+        """Clean everything up."""
+        if self.do_clean and os.path.exists(self.tmp_root) and os.path.isdir(self.tmp_root):
+            if (self.failed or self.errored) and not self.clean_on_failure:
+                # when not clean_on_failure and errors/failures encountered, no-op
+                self.logger.info("Not cleaning because clean_on_failure is false and there were errors/failures.")
+                return
+
+            self.logger.info("Removing all traces of Goss from the system")
+            self.logger.debug("Recursively removing the temporary root directory %s", self.tmp_root)
+            shutil.rmtree(self.tmp_root)
+
+            if self.bundle and not self.keep_bundle:
+                self.clean_bundle()
+        elif not self.do_clean:
+            self.logger.info("Cleaning is disabled, taking no action to remove %s", self.tmp_root)
+        else:
+            self.logger.error("Unable to clean up: %s is not a directory on disk", self.tmp_root)
+
+    def clean_bundle(self):
+        """Remove the bundle, its unpacked tests, and a Goss binary pushed beside it, then its directory if empty."""
+        parent = os.path.dirname(self.bundle)
+        paths = [self.bundle, self.get_bundle_dir()]
+
+        if self.binary_path and os.path.dirname(os.path.abspath(self.binary_path)) == os.path.abspath(parent):
+            paths.append(self.binary_path)
+
+        for path in paths:
+            self.logger.debug("Removing %s", path)
+
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+        try:
+            os.rmdir(parent)
+        except OSError:
+            # other bundles or files are still in it
+            pass
 
     def fail(self, message, **kwargs):
         """Fail with a message."""
@@ -444,9 +2336,11 @@ class Degoss(object):
         except Exception as e:
             self.logger.error("Exception raised when trying to clean up: %s", e)
 
-        output_lines = [line for line in self.log_output.getvalue().split(os.linesep) if len(line) > 0]
+        output_lines = list(self.log_output)
+        result_file = self.result_file if os.path.exists(self.result_file) else None
         self.module.exit_json(failed=True, module_failed=True, msg=message, output_lines=output_lines,
-            test_count=self.total_tests, failed_tests=self.failed_tests, **kwargs)
+            test_count=self.total_tests, failed_tests=self.failed_tests, timings=self.timings, result_file=result_file,
+            **kwargs)
 
 
 if __name__ == "__main__":
@@ -2,19 +2,77 @@
 # -*- coding utf-8 -*-
 
 from callback_plugins.degoss_format import CallbackModule as DegossCallbackModule
+from filter_plugins.degoss_filters import bundle_entries, referenced_vars, select_facts, tree_hash
 from library.degoss import (
     CONSOLE_LOGGING_FORMAT,
     DISK_LOGGING_FORMAT,
-    Degoss
+    Degoss,
+    ResultStreamParser,
+    TEMPLATE_ESCAPE,
+    escape_template,
+    unescape_template,
 )
 
+import csv
+import gzip
+import hashlib
+import io
 import json
 import logging
 import mock
 import os
+import shutil
+import signal
+import socket
+import stat
 import subprocess
 import sys
+import tarfile
+import tempfile
+import time
+import threading
 import unittest
+import xml.etree.ElementTree as ElementTree
+
+try:
+    import http.client as http_client
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+except ImportError:
+    import httplib as http_client
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+
+# templates the test file given to a stand-in for goss like goss does, knowing only the escaped template delimiter
+TEMPLATE_SCRIPT = """
+text = open(sys.argv[sys.argv.index('--gossfile') + 1]).read()
+if '{{{{' in text.replace({escape!r}, ''):
+    sys.exit('unable to template ' + text)
+document = json.loads(text.replace({escape!r}, '{{{{'))
+""".format(escape=TEMPLATE_ESCAPE)
+
+
+def load_result(path):
+    """Load a result document from disk, decompressing it if it is gzipped."""
+    with (gzip.open if path.endswith('.gz') else open)(path, 'rb') as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+def serve_directory(directory):
+    """Serve a directory over HTTP on an ephemeral local port, standing in for GitHub; returns the server."""
+    class Handler(SimpleHTTPRequestHandler):
+        def translate_path(self, path):
+            return os.path.join(directory, *path.split('?')[0].strip('/').split('/'))
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05})
+    thread.daemon = True
+    thread.start()
+
+    return server
 
 
 class DegossTestCase(unittest.TestCase):
@@ -61,6 +119,38 @@ class DegossTestCase(unittest.TestCase):
         self.service.logger = self.logger
         self.service.os, self.service.arch = 'linux', 'amd64'
 
+    def make_directory(self):
+        """Create a temporary directory which is removed once the test finishes."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        return directory
+
+    def make_degoss(self, **params):
+        """Create a service with the given parameters and its directories set up, logging to the stub logger."""
+        self.module.params.update(params)
+
+        service = Degoss(sys.argv, self.module)
+        service.logger, service.os, service.arch = self.logger, 'linux', 'amd64'
+        service.setup_directories()
+
+        return service
+
+    def write_fake_goss(self, path, output='', rc=0, lines=None):
+        """
+        Write a stand-in for Goss to the path which runs the given lines of python, with json, os, shutil, and sys
+        imported, or otherwise reads its variables and prints the output, exiting with the return code.
+        """
+        if lines is None:
+            lines = ["sys.stdin.read()", "sys.stdout.write({!r})".format(output), "sys.exit({})".format(rc)]
+
+        with open(path, 'w') as f:
+            f.write("#!{}\n".format(sys.executable))
+            f.write("import json, os, shutil, sys\n")
+            f.write("\n".join(lines) + "\n")
+
+        os.chmod(path, 0o700)
+
     def test_get_boolean(self):
         """Test that boolean resolution works as expected."""
         self.assertTrue(self.service.get_bool('literal_true'))
@@ -222,10 +312,10 @@ class DegossTestCase(unittest.TestCase):
         self.assertEqual(mock_os, self.service.os)
 
     @mock.patch('library.degoss.logging.FileHandler')
-    @mock.patch('library.degoss.logging.StreamHandler')
+    @mock.patch('library.degoss.BufferHandler')
     @mock.patch('library.degoss.logging.getLogger')
     @mock.patch('library.degoss.logging.addLevelName')
-    def test_setup_logging(self, mock_add_level_name, mock_get_logger, mock_new_stream_handler,
+    def test_setup_logging(self, mock_add_level_name, mock_get_logger, mock_new_buffer_handler,
             mock_new_file_handler):
         """Tests that logging setup works properly."""
         mock_logger = mock.MagicMock()
@@ -234,8 +324,8 @@ class DegossTestCase(unittest.TestCase):
         mock_file_handler = mock.MagicMock()
         mock_new_file_handler.return_value = mock_file_handler
 
-        mock_stream_handler = mock.MagicMock()
-        mock_new_stream_handler.return_value = mock_stream_handler
+        mock_buffer_handler = mock.MagicMock()
+        mock_new_buffer_handler.return_value = mock_buffer_handler
 
         self.service = Degoss(sys.argv, self.module)
         logger = self.service.setup_logging()
@@ -247,11 +337,11 @@ class DegossTestCase(unittest.TestCase):
         mock_get_logger.assert_called_with('degoss')
         mock_logger.setLevel.assert_called_with(logging.DEBUG)
         mock_logger.addHandler.assert_any_call(mock_file_handler)
-        mock_logger.addHandler.assert_any_call(mock_stream_handler)
+        mock_logger.addHandler.assert_any_call(mock_buffer_handler)
 
         # handlers
         mock_new_file_handler.assert_called_with(filename=self.service.log_file)
-        mock_new_stream_handler.assert_called_with(stream=self.service.log_output)
+        mock_new_buffer_handler.assert_called_with(self.service.log_output)
 
         # return value must equal the logger created
         self.assertEqual(mock_logger, logger)
@@ -263,6 +353,30 @@ class DegossTestCase(unittest.TestCase):
 
         mock_logger.setLevel.assert_called_with(logging.INFO)
 
+    def test_setup_logging_handlers(self):
+        """Tests that repeated logging setup replaces handlers, keeps a bounded buffer, and rotates a persistent log."""
+        directory = self.make_directory()
+        persistent_log = os.path.join(directory, 'persistent', 'degoss.log')
+
+        for i in range(3):
+            self.service = self.make_degoss(tmp_root=os.path.join(directory, str(i)), log_buffer_lines=5,
+                persistent_log=persistent_log, persistent_log_max_bytes=1024, persistent_log_backups=2)
+            logger = self.service.setup_logging()
+
+        self.assertEqual(3, len(logger.handlers))
+
+        for handler in logger.handlers:
+            self.addCleanup(handler.close)
+            self.addCleanup(logger.removeHandler, handler)
+
+        for i in range(100):
+            logger.info("line %d\nof record", i)
+
+        self.assertEqual(['[INFO ] line 98', 'of record', '[INFO ] line 99', 'of record'],
+            list(self.service.log_output)[1:])
+        self.assertEqual(['degoss.log', 'degoss.log.1', 'degoss.log.2'],
+            sorted(os.listdir(os.path.dirname(persistent_log))))
+
     @mock.patch('library.degoss.os.chmod')
     @mock.patch('library.degoss.os.makedirs')
     @mock.patch('library.degoss.os.path.isdir')
@@ -282,8 +396,46 @@ class DegossTestCase(unittest.TestCase):
         mock_chmod.assert_any_call(self.service.bin_dir, 0o0755)
         mock_chmod.assert_any_call(self.service.log_dir, 0o0755)
 
-    @mock.patch('library.degoss.Request')
-    @mock.patch('library.degoss.urlopen')
+    def test_get_release_url_mirror(self):
+        """Tests that release URLs can point at a mirror or a local path."""
+        self.module.params.update(repo_url='https://mirror.example.com/goss/')
+        self.service = Degoss(sys.argv, self.module)
+        self.service.os, self.service.arch = 'linux', 'amd64'
+
+        self.assertEqual("https://mirror.example.com/goss/releases/download/v0.3.6/goss-linux-amd64",
+            self.service.get_release_url())
+
+        self.service.release_url = 'file:///srv/goss/{version}/goss-{os}-{arch}'
+        self.assertEqual('file:///srv/goss/0.3.6/goss-linux-amd64', self.service.get_release_url())
+
+    def test_request_local_sources(self):
+        """Tests that degoss can fetch from a local HTTP mirror and file:// URLs, and never hits the network offline."""
+        directory = self.make_directory()
+
+        with open(os.path.join(directory, 'goss-linux-amd64'), 'wb') as f:
+            f.write(b'goss')
+
+        server = serve_directory(directory)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        status, _, response = self.service.request('http://127.0.0.1:{}/goss-linux-amd64'.format(server.server_port))
+        self.assertEqual(200, status)
+        self.assertEqual(b'goss', response.read())
+        response.close()
+
+        self.service.offline = True
+        self.service.fail = mock.MagicMock(side_effect=RuntimeError)
+
+        _, _, response = self.service.request('file://' + os.path.join(directory, 'goss-linux-amd64'))
+        self.assertEqual(b'goss', response.read())
+        response.close()
+
+        self.assertRaises(RuntimeError, self.service.request, 'https://github.com/aelsabbahy/goss/releases/latest')
+        self.assertRaises(RuntimeError, self.service.get_latest_version)
+
+    @mock.patch('ansible.module_utils.six.moves.urllib.request.Request')
+    @mock.patch('ansible.module_utils.six.moves.urllib.request.urlopen')
     def test_request(self, mock_urlopen, mock_new_request):
         """Tests that degoss can create URL requests."""
         mock_request = mock.MagicMock()
@@ -316,38 +468,205 @@ class DegossTestCase(unittest.TestCase):
         self.assertEqual('0.3.6', result)
         mock_new_request.assert_called_with("https://github.com/aelsabbahy/goss/releases/latest")
 
-    @mock.patch('library.degoss.os.chmod')
     @mock.patch.object(Degoss, 'request')
-    @mock.patch.object(Degoss, 'get_release_url')
-    def test_install(self, mock_get_release_url, mock_new_request, mock_chmod):
-        """Tests that degoss can install Goss successfully."""
-        mock_get_release_url.return_value = 'fhwgads'
-
-        # mock up the response as a file like object
-        chunk_status = { 'emitted': False }
-        def chunk_once(self):
-            if not chunk_status['emitted']:
-                chunk_status['emitted'] = True
-                return "ABCDEFG"
-            else:
-                return None
+    def test_get_latest_version_cached(self, mock_new_request):
+        """Tests that the latest version of Goss is cached on the host until it expires."""
+        cache_dir = self.make_directory()
 
-        mock_response = mock.MagicMock()
-        mock_response.read = chunk_once
-        mock_new_request.return_value = 200, 'url', mock_response
+        self.service.cache_dir, self.service.version_cache_ttl = cache_dir, 3600
+        mock_new_request.return_value = 200, 'aelsabbahy/goss/releases/tag/v0.3.6', mock.MagicMock()
 
-        patched_open = mock.mock_open()
-        with mock.patch("library.degoss.open", patched_open, create=True):
-            self.service.install()
+        self.assertEqual('0.3.6', self.service.get_latest_version())
+        self.assertEqual('0.3.6', self.service.get_latest_version())
+        self.assertEqual(1, mock_new_request.call_count)
 
-        mock_get_release_url.assert_called_with()
-        mock_new_request.assert_called_with('fhwgads')
+        # once expired, it must be resolved again
+        with open(os.path.join(cache_dir, 'latest-version.json'), 'w') as f:
+            json.dump({'version': '0.3.6', 'resolved_at': time.time() - 7200}, f)
 
-        patched_open.assert_called_with(self.service.executable, 'w')
-        file_handle = patched_open()
-        file_handle.write.assert_called_with('ABCDEFG')
+        mock_new_request.return_value = 200, 'aelsabbahy/goss/releases/tag/v0.3.7', mock.MagicMock()
+        self.assertEqual('0.3.7', self.service.get_latest_version())
+        self.assertEqual(2, mock_new_request.call_count)
+
+    def test_install(self):
+        """Tests that degoss can download, verify, and install Goss from a release server."""
+        tmp_root, directory = self.make_directory(), self.make_directory()
+
+        release_dir = os.path.join(directory, 'releases', 'download', 'v0.3.6')
+        os.makedirs(release_dir)
+
+        binary = b'\x7fELF' + os.urandom(4096)
+
+        with open(os.path.join(release_dir, 'goss-linux-amd64'), 'wb') as f:
+            f.write(binary)
+
+        with open(os.path.join(release_dir, 'goss-linux-amd64.sha256'), 'w') as f:
+            f.write("{}  goss-linux-amd64\n".format(hashlib.sha256(binary).hexdigest()))
+
+        server = serve_directory(directory)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        self.service = self.make_degoss(tmp_root=tmp_root, repo_url='http://127.0.0.1:{}'.format(server.server_port))
+        self.service.fail = mock.MagicMock(side_effect=RuntimeError)
+
+        self.service.install()
+
+        with open(self.service.executable, 'rb') as f:
+            self.assertEqual(binary, f.read())
+
+        self.assertEqual(0o700, stat.S_IMODE(os.stat(self.service.executable).st_mode))
+        self.assertFalse(os.path.exists(self.service.executable + '.part'))
+        self.assertEqual(len(binary), self.service.download_bytes)
+        self.assertEqual(['install.download', 'install.verify'], list(self.service.timings.keys()))
+        self.assertEqual(self.service.timings['install.download'], self.service.download_seconds)
+
+        # a binary not matching the expected checksum must never be installed
+        os.remove(self.service.executable)
+        self.service.checksum = '0' * 64
+
+        self.assertRaises(RuntimeError, self.service.install)
+        self.assertFalse(os.path.exists(self.service.executable))
+
+    @mock.patch.object(Degoss, 'request')
+    def test_fetch_resume(self, mock_request):
+        """Tests that degoss resumes partial downloads with HTTP range requests."""
+        directory = self.make_directory()
+
+        destination = os.path.join(directory, 'goss.part')
+
+        with open(destination, 'wb') as f:
+            f.write(b'ABC')
+
+        # server honors the range
+        mock_request.return_value = 206, 'url', io.BytesIO(b'DEFG')
+
+        self.assertEqual(4, self.service.fetch('url', destination))
+        mock_request.assert_called_with('url', headers={'Range': 'bytes=3-'})
+
+        with open(destination, 'rb') as f:
+            self.assertEqual(b'ABCDEFG', f.read())
+
+        # server ignores the range and sends everything again
+        mock_request.return_value = 200, 'url', io.BytesIO(b'ABCDEFG')
+
+        self.assertEqual(7, self.service.fetch('url', destination))
+
+        with open(destination, 'rb') as f:
+            self.assertEqual(b'ABCDEFG', f.read())
+
+    @mock.patch.object(Degoss, 'verify_download')
+    @mock.patch.object(Degoss, 'fetch')
+    def test_download_interrupted(self, mock_fetch, mock_verify_download):
+        """Tests that degoss resumes downloads cut short or stalled while reading the body."""
+        self.service = self.make_degoss(tmp_root=self.make_directory())
+        self.service.fail = mock.MagicMock(side_effect=RuntimeError)
+
+        with open(self.service.executable + '.part', 'wb') as f:
+            f.write(b'ABCDEFG')
+
+        mock_fetch.side_effect = [http_client.IncompleteRead(b'AB', 5), socket.timeout('timed out'), 5]
+
+        self.service.download()
+
+        self.assertEqual(3, mock_fetch.call_count)
+        self.assertEqual(5, self.service.download_bytes)
+        self.assertTrue(os.path.isfile(self.service.executable))
+        self.service.fail.assert_not_called()
+
+    @mock.patch.object(Degoss, 'download')
+    def test_install_cache(self, mock_download):
+        """Tests that installed binaries are cached, reused, and verified by checksum."""
+        tmp_root = self.make_directory()
+        self.service = self.make_degoss(tmp_root=os.path.join(tmp_root, 'run'),
+            cache_dir=os.path.join(tmp_root, 'cache'))
+
+        def download():
+            with open(self.service.executable, 'wb') as f:
+                f.write(b'goss')
+
+        mock_download.side_effect = download
+
+        # cache miss, the binary is downloaded and then stored
+        self.service.install()
+        mock_download.assert_called_once_with()
+
+        binary, checksum_file = self.service.get_cache_paths()
+        self.assertEqual(os.path.join(tmp_root, 'cache', 'goss-0.3.6-linux-amd64'), binary)
+
+        with open(binary, 'rb') as f:
+            self.assertEqual(b'goss', f.read())
+
+        # cache hit, the binary is copied into place without downloading
+        os.remove(self.service.executable)
+        mock_download.reset_mock()
+
+        self.service.install()
+        mock_download.assert_not_called()
+
+        with open(self.service.executable, 'rb') as f:
+            self.assertEqual(b'goss', f.read())
+
+        # corrupted cache entry, it is evicted and downloaded again
+        with open(binary, 'wb') as f:
+            f.write(b'corrupted')
+
+        self.service.install()
+        mock_download.assert_called_once_with()
+
+        with open(binary, 'rb') as f:
+            self.assertEqual(b'goss', f.read())
+
+    @mock.patch.object(Degoss, 'request')
+    def test_install_binary_path(self, mock_request):
+        """Tests that degoss installs a binary already on the host without downloading."""
+        tmp_root = self.make_directory()
+        binary_path = os.path.join(tmp_root, 'goss')
+
+        with open(binary_path, 'wb') as f:
+            f.write(b'goss')
+
+        self.service = self.make_degoss(tmp_root=tmp_root, binary_path=binary_path)
 
-        mock_chmod.assert_called_with(self.service.executable, 0o700)
+        self.service.install()
+
+        mock_request.assert_not_called()
+
+        with open(self.service.executable, 'rb') as f:
+            self.assertEqual(b'goss', f.read())
+
+        self.assertTrue(os.stat(self.service.executable).st_mode & 0o100)
+
+    def test_evict_cache(self):
+        """Tests that the binary cache evicts expired and least recently used entries."""
+        cache_dir = self.make_directory()
+
+        self.service.cache_dir, self.service.cache_max_age, self.service.cache_max_size = cache_dir, 3600, 10
+        now = time.time()
+
+        def entry(name, size, age):
+            path = os.path.join(cache_dir, name)
+
+            for filename in (path, path + '.sha256'):
+                with open(filename, 'w') as f:
+                    f.write('x' * size)
+
+            os.utime(path, (now - age, now - age))
+
+            return path
+
+        expired = entry('goss-0.3.1-linux-amd64', 1, 7200)
+        oldest = entry('goss-0.3.2-linux-amd64', 4, 60)
+        newest = entry('goss-0.3.3-linux-amd64', 4, 30)
+        current = entry('goss-0.3.4-linux-amd64', 4, 0)
+
+        self.service.evict_cache(keep=current)
+
+        self.assertFalse(os.path.exists(expired))
+        self.assertFalse(os.path.exists(expired + '.sha256'))
+        self.assertFalse(os.path.exists(oldest))
+        self.assertTrue(os.path.exists(newest))
+        self.assertTrue(os.path.exists(current))
 
     @mock.patch.object(Degoss, 'fail')
     @mock.patch('library.degoss.subprocess.Popen')
@@ -385,14 +704,14 @@ class DegossTestCase(unittest.TestCase):
 
         patched_open = mock.mock_open()
         # run
-        with mock.patch("library.degoss.open", patched_open, create=True):
+        with mock.patch("library.degoss.open_result", patched_open):
             self.service.test()
 
         # it must have opened the result file
-        patched_open.assert_called_with(self.service.result_file, 'w')
+        patched_open.assert_called_with(self.service.result_file)
         file_handle = patched_open()
-        # it must have written the result to the result file
-        file_handle.write.assert_called_with(json.dumps(result_dict, indent=2, sort_keys=True))
+        # it must have written the result to the result file compactly
+        file_handle.write.assert_called_with(json.dumps(result_dict, separators=(',', ':')))
 
         # a new process should have been opened like this
         mock_new_popen.assert_called_with(
@@ -406,7 +725,7 @@ class DegossTestCase(unittest.TestCase):
         )
 
         # communicate must be called to send variables like this
-        mock_process.communicate.assert_called_with(input=json.dumps(goss_variables))
+        mock_process.communicate.assert_called_with(input=json.dumps(goss_variables).encode('utf-8'))
 
         # it must not have failed
         mock_fail.assert_not_called()
@@ -443,13 +762,13 @@ class DegossTestCase(unittest.TestCase):
 
         patched_open = mock.mock_open()
         # run
-        with mock.patch("library.degoss.open", patched_open, create=True):
+        with mock.patch("library.degoss.open_result", patched_open):
             self.service.test()
 
-        patched_open.assert_called_with(self.service.result_file, 'w')
+        patched_open.assert_called_with(self.service.result_file)
         file_handle = patched_open()
         # result file must be written
-        file_handle.write.assert_called_with(json.dumps(result_dict, indent=2, sort_keys=True))
+        file_handle.write.assert_called_with(json.dumps(result_dict, separators=(',', ':')))
 
         # just stubs here, all the logic up until process execution completion is the same
 
@@ -457,7 +776,7 @@ class DegossTestCase(unittest.TestCase):
         mock_new_popen.assert_called()
 
         # communicate must be passed varialbes
-        mock_process.communicate.assert_called_with(input='{}')
+        mock_process.communicate.assert_called_with(input=b'{}')
 
         # instance variables
         self.assertEqual(result_dict, self.service.test_result)
@@ -493,13 +812,695 @@ class DegossTestCase(unittest.TestCase):
         file_handle.write.assert_not_called()
 
         mock_new_popen.assert_called()
-        mock_process.communicate.assert_called_with(input='{}')
+        mock_process.communicate.assert_called_with(input=b'{}')
         mock_fail.assert_called_with("Goss Execution Failed (Unable to run tests) (rc=1)", stdout_lines=[result_string], rc=1 )
 
         self.assertTrue(self.service._errored)
         self.assertTrue(self.service.errored)
 
 
+    @mock.patch.object(Degoss, 'fail')
+    @mock.patch('library.degoss.subprocess.Popen')
+    def test_run_tests_multiple_files(self, mock_new_popen, mock_fail):
+        """Tests that degoss runs multiple test files concurrently and merges their results."""
+        tmp_root = self.make_directory()
+        test_dir = os.path.join(tmp_root, 'tests')
+        os.makedirs(os.path.join(test_dir, 'more'))
+
+        for name in ('dingo.yml', 'more/one.yml', 'more/two.yml', 'more/skipped.json'):
+            open(os.path.join(test_dir, name), 'w').close()
+
+        documents = {
+            'dingo.yml': {
+                'results': [{'summary-line': 'dingo passed', 'successful': True}],
+                'summary': {'failed-count': 0, 'test-count': 1, 'total-duration': 1000000000},
+            },
+            'more/one.yml': {
+                'results': [{'summary-line': 'one failed', 'successful': False}],
+                'summary': {'failed-count': 1, 'test-count': 1, 'total-duration': 2000000000},
+            },
+            'more/two.yml': {
+                'results': [{'summary-line': 'two passed', 'successful': True}] * 2,
+                'summary': {'failed-count': 0, 'test-count': 2, 'total-duration': 500000000},
+            },
+        }
+
+        def new_popen(cli_arguments, **kwargs):
+            process = mock.MagicMock()
+            process.returncode = 0
+            process.communicate.return_value = json.dumps(documents[cli_arguments[2]]), None
+
+            return process
+
+        mock_new_popen.side_effect = new_popen
+
+        self.service = self.make_degoss(tmp_root=tmp_root, test_dir=test_dir, test_file=['dingo.yml', 'more/*.yml'],
+            workers=2)
+        self.service.facts, self.service.variables = {}, {}
+
+        self.service.test()
+
+        mock_fail.assert_not_called()
+
+        self.assertEqual(['dingo.yml', 'more/one.yml', 'more/two.yml'],
+            sorted(call[0][0][2] for call in mock_new_popen.call_args_list))
+
+        self.assertEqual(4, self.service.total_tests)
+        self.assertEqual(1, self.service.failed_tests)
+        self.assertEqual(['one failed'], self.service.failed_messages)
+        self.assertEqual(4, len(self.service.test_result['results']))
+        self.assertEqual(2000000000, self.service.test_result['summary']['total-duration'])
+        self.assertEqual({
+            'dingo.yml': {'tests_failed': 0, 'tests_skipped': 0, 'tests_total': 1},
+            'more/one.yml': {'tests_failed': 1, 'tests_skipped': 0, 'tests_total': 1},
+            'more/two.yml': {'tests_failed': 0, 'tests_skipped': 0, 'tests_total': 2},
+        }, self.service.file_results)
+
+        self.assertEqual(self.service.test_result, load_result(self.service.result_file))
+
+    def test_merge_results_null(self):
+        """Tests that test files without any tests, which Goss reports as null results, are merged."""
+        merged = self.service.merge_results([
+            ('empty.yml', {'results': None, 'summary': {'failed-count': 0, 'test-count': 0}}),
+            ('one.yml', {'results': [{'successful': True}], 'summary': {'failed-count': 0, 'test-count': 1}}),
+        ])
+
+        self.assertEqual([{'successful': True}], merged['results'])
+        self.assertEqual(1, merged['summary']['test-count'])
+
+        with mock.patch('library.degoss.open_result', mock.mock_open()):
+            self.service.collect_results([('empty.yml', {'results': None, 'summary': {'failed-count': 0,
+                'test-count': 0}})])
+
+        self.assertEqual((0, 0, 0), (self.service.total_tests, self.service.failed_tests, self.service.skipped_tests))
+
+    def test_write_variables(self):
+        """Tests that streamed variables match the merged variables, with user variables overriding facts."""
+        self.service.facts = {'fact1': True, 'ansible_fact2': [1, 2], 'fact3': 'overridden'}
+        self.service.variables = {'var1': {'nested': None}, 'ansible_fact3': 'winner'}
+
+        expected = {
+            'ansible_fact1': True,
+            'ansible_fact2': [1, 2],
+            'ansible_fact3': 'winner',
+            'var1': {'nested': None},
+        }
+
+        self.assertEqual(expected, dict(self.service.iter_variables()))
+
+        stream = mock.MagicMock()
+        self.service.write_variables(stream)
+
+        self.assertEqual(expected, json.loads(b''.join(call[0][0] for call in stream.write.call_args_list)))
+        stream.close.assert_called_with()
+
+        # empty
+        self.service.facts, self.service.variables = {}, {}
+        stream.reset_mock()
+        self.service.write_variables(stream)
+
+        self.assertEqual({}, json.loads(b''.join(call[0][0] for call in stream.write.call_args_list)))
+
+    def test_run_tests_streamed(self):
+        """Tests that streamed variables reach a real Goss process on standard input."""
+        tmp_root = self.make_directory()
+        self.service = self.make_degoss(tmp_root=tmp_root, test_dir=tmp_root, stream_variables=True)
+
+        # a stand-in for goss which reports one test per variable it received
+        self.write_fake_goss(self.service.executable, lines=[
+            "variables = json.load(sys.stdin)",
+            "print(json.dumps({'results': [], 'summary': {'failed-count': 0, 'test-count': len(variables)}}))",
+        ])
+
+        self.service.facts = {'fact{}'.format(i): 'x' * 100 for i in range(5000)}
+        self.service.variables = {'var1': True}
+
+        self.service.test()
+
+        self.assertEqual(5001, self.service.total_tests)
+        self.assertFalse(self.service.errored)
+
+    def test_result_stream_parser(self):
+        """Tests that Goss results are parsed incrementally regardless of how the output is chunked."""
+        document = {
+            'results': [
+                {'resource-id': 'hostname', 'successful': True, 'summary-line': 'passed: \\"}],[{'},
+                {'resource-id': '/dev', 'successful': False, 'summary-line': 'failed'},
+            ],
+            'summary': {'failed-count': 1, 'test-count': 2, 'total-duration': 12345},
+        }
+        output = json.dumps(document, indent=4)
+
+        for chunk_size in (1, 7, len(output)):
+            results = []
+            parser = ResultStreamParser(results.append)
+
+            for index in range(0, len(output), chunk_size):
+                parser.feed(output[index:index + chunk_size])
+
+            self.assertTrue(parser.complete)
+            self.assertEqual(document['results'], results)
+            self.assertEqual({'summary': document['summary']}, parser.document)
+
+        # empty results
+        parser = ResultStreamParser(results.append)
+        parser.feed('{"results": [], "summary": {}}')
+        self.assertTrue(parser.complete)
+
+        # goss reports no results as null, and any other value may be null too
+        output = '{"results": null, "meta": null, "summary": {"failed-count": 0, "test-count": 0}}'
+
+        for chunk_size in (1, len(output)):
+            results = []
+            parser = ResultStreamParser(results.append)
+
+            for index in range(0, len(output), chunk_size):
+                parser.feed(output[index:index + chunk_size])
+
+            self.assertTrue(parser.complete)
+            self.assertEqual([], results)
+            self.assertEqual({'meta': None, 'summary': {'failed-count': 0, 'test-count': 0}}, parser.document)
+
+        parser = ResultStreamParser(results.append)
+        parser.feed('{"results": "none"}')
+        self.assertTrue(parser.failed)
+
+        # not a result document
+        parser = ResultStreamParser(results.append)
+        parser.feed("Error: file not found\n")
+        self.assertTrue(parser.failed)
+        self.assertFalse(parser.complete)
+
+    def test_run_tests_stream_results(self):
+        """Tests that streamed results are written to disk as they arrive while only failures are kept in memory."""
+        tmp_root = self.make_directory()
+        self.service = self.make_degoss(tmp_root=tmp_root, test_dir=tmp_root, stream_results=True)
+
+        document = {
+            'results': [
+                {'resource-id': str(i), 'successful': i % 1000 != 0, 'summary-line': 'check {}'.format(i)}
+                for i in range(5000)
+            ],
+            'summary': {'failed-count': 5, 'test-count': 5000},
+        }
+
+        # a stand-in for goss which emits a large result document
+        self.write_fake_goss(self.service.executable, json.dumps(document, indent=4))
+
+        self.service.facts, self.service.variables = {}, {}
+        self.service.test()
+
+        self.assertFalse(self.service.errored)
+        self.assertEqual(5000, self.service.total_tests)
+        self.assertEqual(5, self.service.failed_tests)
+        self.assertEqual(['check {}'.format(i) for i in range(0, 5000, 1000)], self.service.failed_messages)
+        self.assertEqual(5, len(self.service.test_result['results']))
+        self.assertEqual(['test.variables', 'test.goss', 'test.parse', 'test.write'],
+            list(self.service.timings.keys()))
+
+        self.assertEqual(document, load_result(self.service.result_file))
+
+        # output which is not a result document is reported
+        self.write_fake_goss(self.service.executable, "Error: no such file\n")
+
+        self.service.fail = mock.MagicMock()
+        self.service.test()
+
+        self.service.fail.assert_called_with("Goss Execution Failed (Unable to run tests) (rc=0)",
+            stdout_lines=["Error: no such file", ""], rc=0)
+
+    def test_result_detail(self):
+        """Tests that the returned result is reduced to the requested detail while the file keeps all of it."""
+        tmp_root = self.make_directory()
+
+        document = {
+            'results': [
+                {'resource-id': 'passed', 'successful': True, 'summary-line': 'passed'},
+                {'resource-id': 'failed', 'successful': False, 'summary-line': 'failed'},
+            ],
+            'summary': {'failed-count': 1, 'test-count': 2},
+        }
+
+        expected = {
+            'full': (document, ['failed']),
+            'failures_only': ({'results': document['results'][1:], 'summary': document['summary']}, ['failed']),
+            'summary': ({'summary': document['summary']}, None),
+        }
+
+        for stream_results in (False, True):
+            for result_detail, (test_result, failed_messages) in expected.items():
+                self.service = self.make_degoss(tmp_root=tmp_root, test_dir=tmp_root, stream_results=stream_results,
+                    result_detail=result_detail)
+                self.write_fake_goss(self.service.executable, json.dumps(document))
+
+                self.service.facts, self.service.variables = {}, {}
+                self.service.test()
+
+                if stream_results and result_detail == 'full':
+                    # streaming only ever keeps the failures in memory
+                    test_result = expected['failures_only'][0]
+
+                self.assertEqual(test_result, self.service.test_result)
+                self.assertEqual(failed_messages, self.service.failed_messages)
+                self.assertEqual(1, self.service.failed_tests)
+
+                self.assertEqual(document, load_result(self.service.result_file))
+
+    def test_result_archive(self):
+        """Tests that results can be written uncompressed, or archived outside of the temporary root."""
+        directory = self.make_directory()
+        tmp_root = os.path.join(directory, 'degoss.abc')
+
+        self.module.params.update(tmp_root=tmp_root, test_dir=tmp_root, result_compression='none')
+        self.assertEqual(os.path.join(tmp_root, 'result.json'), Degoss(sys.argv, self.module).result_file)
+
+        archive = os.path.join(directory, 'degoss.abc.result.json.gz')
+        self.service = self.make_degoss(result_archive=archive)
+        self.write_fake_goss(self.service.executable, json.dumps({'results': [], 'summary': {'test-count': 0}}))
+
+        self.service.facts, self.service.variables = {}, {}
+        self.service.test()
+        self.service.do_clean = True
+        self.service.clean()
+
+        self.assertEqual(archive, self.service.result_file)
+        self.assertFalse(os.path.exists(tmp_root))
+        self.assertEqual({'results': [], 'summary': {'test-count': 0}}, load_result(archive))
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(archive).st_mode))
+
+    def test_unpack_bundle(self):
+        """Tests that the module creates its workdir and unpacks the test bundle once, removing unused bundles."""
+        directory = self.make_directory()
+        sources, bundles = os.path.join(directory, 'sources'), os.path.join(directory, 'bundles')
+        os.makedirs(os.path.join(sources, 'more'))
+        os.makedirs(os.path.join(bundles, 'e' * 64))
+        os.makedirs(os.path.join(bundles, 'f' * 64))
+        open(os.path.join(bundles, 'keep.txt'), 'w').close()
+
+        # an unused bundle of other tests is pruned, while a recently used one may belong to a concurrent run
+        os.utime(os.path.join(bundles, 'f' * 64), (time.time() - 7200, time.time() - 7200))
+
+        for name in ('goss.yml', 'more/one.yml'):
+            with open(os.path.join(sources, name), 'w') as f:
+                f.write("file: {}\n")
+
+        bundle = os.path.join(bundles, 'a' * 64 + '.tar.gz')
+
+        with tarfile.open(bundle, 'w:gz') as archive:
+            archive.add(os.path.join(sources, 'goss.yml'), 'goss.yml')
+            archive.add(os.path.join(sources, 'more'), 'more')
+
+        self.service = self.make_degoss(base_workdir=directory, bundle=bundle, tmp_root=None, test_dir=None)
+
+        self.assertEqual(directory, os.path.dirname(self.service.tmp_root))
+        self.assertTrue(os.path.basename(self.service.tmp_root).startswith('degoss.'))
+        self.assertEqual(os.path.join(bundles, 'a' * 64), self.service.test_dir)
+
+        self.service.unpack_bundle()
+
+        self.assertTrue(os.path.isfile(os.path.join(self.service.test_dir, 'more', 'one.yml')))
+        self.assertEqual({'files': 3, 'round_trips_saved': 3}, self.service.setup)
+        self.assertEqual(sorted(['a' * 64, 'a' * 64 + '.tar.gz', 'e' * 64, 'keep.txt']), sorted(os.listdir(bundles)))
+
+        # an unpacked bundle is reused
+        os.remove(os.path.join(self.service.test_dir, 'goss.yml'))
+        self.service.unpack_bundle()
+        self.assertFalse(os.path.exists(os.path.join(self.service.test_dir, 'goss.yml')))
+
+        # members outside of the test directory are refused
+        bundle = os.path.join(bundles, 'b' * 64 + '.tar')
+
+        with tarfile.open(bundle, 'w') as archive:
+            archive.add(os.path.join(sources, 'goss.yml'), '../goss.yml')
+
+        self.service = self.make_degoss(bundle=bundle)
+        self.service.fail = mock.MagicMock()
+        self.service.unpack_bundle()
+
+        self.service.fail.assert_called_with("Refusing to unpack ../goss.yml from test bundle {}".format(bundle))
+        self.assertFalse(os.path.exists(os.path.join(directory, 'goss.yml')))
+
+        # tests and binaries in a directory which others can write to are never used
+        os.chmod(bundles, 0o777)
+        self.service.fail.reset_mock()
+        self.service.unpack_bundle()
+
+        self.service.fail.assert_called_with("Refusing to use {}, which is not a directory owned by the current user "
+            "or root and writable only by its owner".format(bundles))
+
+    def test_clean_bundle(self):
+        """Tests that cleaning up removes the bundle and a binary pushed beside it unless it is to be kept."""
+        directory = self.make_directory()
+        bundles = os.path.join(directory, 'bundles')
+        bundle, binary_path = os.path.join(bundles, 'a' * 64 + '.tar.gz'), os.path.join(bundles, 'goss-linux-amd64')
+        os.makedirs(os.path.join(bundles, 'a' * 64))
+
+        for path in (bundle, binary_path):
+            open(path, 'w').close()
+
+        self.service = self.make_degoss(base_workdir=directory, binary_path=binary_path, bundle=bundle, clean=True,
+            keep_bundle=True, tmp_root=None, test_dir=None)
+        self.service.clean()
+
+        self.assertEqual(sorted(['a' * 64, 'a' * 64 + '.tar.gz', 'goss-linux-amd64']), sorted(os.listdir(bundles)))
+
+        self.service = self.make_degoss(keep_bundle=False)
+        self.service.clean()
+
+        self.assertEqual([], os.listdir(directory))
+
+    def test_select(self):
+        """Tests that unselected tests are skipped and previously failed tests are run first."""
+        directory = self.make_directory()
+        test_dir, state_dir = os.path.join(directory, 'tests'), os.path.join(directory, 'state')
+        os.makedirs(test_dir)
+        os.makedirs(state_dir)
+
+        # a test file with a template delimiter in a value, which Goss renders from an escaped one
+        with open(os.path.join(test_dir, 'goss.json'), 'w') as f:
+            f.write(json.dumps({'file': {'a': {'meta': {'tags': ['x']}}, 'b': {'contents': ['{{.Names}}']}},
+                'service': {'c': {}}}).replace('{{', TEMPLATE_ESCAPE))
+
+        # a stand-in for goss which templates and renders test files, failing the resources named in its variables
+        binary_path = os.path.join(directory, 'goss')
+
+        self.write_fake_goss(binary_path, lines=[
+            TEMPLATE_SCRIPT,
+            "failing = json.load(sys.stdin).get('failing', [])",
+            "if 'render' in sys.argv:\n    print(json.dumps(document))\n    sys.exit(0)",
+            "results = [{'resource-type': kind.title(), 'resource-id': rid, 'summary-line': rid,",
+            "    'skipped': bool(r.get('skip')), 'successful': bool(r.get('skip')) or rid not in failing}",
+            "    for kind, resources in document.items() for rid, r in resources.items()]",
+            "print(json.dumps({'results': results, 'summary': {'test-count': len(results),",
+            "    'failed-count': len([r for r in results if not r['successful']])}}))",
+        ])
+
+        def run(failing, **params):
+            self.module.params.update(dict(select='all', resource_types=[], tags=[], state_dir=None), **params)
+
+            service = self.make_degoss(tmp_root=tempfile.mkdtemp(dir=directory), test_dir=test_dir,
+                test_file=['goss.json'])
+            shutil.copy(binary_path, service.executable)
+            service.facts, service.variables = {}, {'failing': failing}
+            service.test()
+
+            self.assertFalse(service.errored)
+
+            return service.total_tests, service.failed_tests, service.skipped_tests
+
+        # filters skip resources of other types or without the tags
+        self.assertEqual((3, 0, 1), run([], resource_types=['file']))
+        self.assertEqual((3, 0, 2), run(['b'], tags=['x']))
+        self.assertEqual((3, 1, 0), run(['b'], state_dir=state_dir))
+
+        with open(os.path.join(state_dir, 'failed.json'), 'r') as f:
+            self.assertEqual([['file', 'b']], json.load(f)['failed'])
+
+        # only the failed test runs first, and everything else runs once it passes
+        self.assertEqual((3, 1, 2), run(['b'], select='failed_first', state_dir=state_dir))
+        self.assertEqual((3, 0, 0), run([], select='failed_first', state_dir=state_dir))
+        self.assertEqual((3, 0, 3), run([], select='failed_only', state_dir=state_dir))
+
+    def test_render_cache(self):
+        """Tests that rendered test files are reused until the tests or the variables change."""
+        directory = self.make_directory()
+        test_dir, cache_dir = os.path.join(directory, 'tests'), os.path.join(directory, 'cache')
+        renders = os.path.join(directory, 'renders')
+        os.makedirs(test_dir)
+
+        with open(os.path.join(test_dir, 'goss.json'), 'w') as f:
+            f.write(json.dumps({'file': {'/etc': {}}}))
+
+        # a stand-in for goss which counts its renders and validates the test file it is given
+        binary_path = os.path.join(directory, 'goss')
+
+        self.write_fake_goss(binary_path, lines=[
+            TEMPLATE_SCRIPT,
+            "variables = json.load(sys.stdin)",
+            "if 'render' in sys.argv:",
+            "    open({!r}, 'a').write('.')".format(renders),
+            "    document['file'].update((name, {}) for name in variables)",
+            "    print(json.dumps(document))\n    sys.exit(0)",
+            "summary = {'failed-count': 0, 'test-count': len(document['file'])}",
+            "print(json.dumps({'results': [], 'summary': summary}))",
+        ])
+
+        def run(variables):
+            service = self.make_degoss(tmp_root=tempfile.mkdtemp(dir=directory), test_dir=test_dir,
+                test_file=['goss.json'], cache_dir=cache_dir, render_cache=True)
+            shutil.copy(binary_path, service.executable)
+            service.facts, service.variables = {}, variables
+            service.test()
+
+            self.assertFalse(service.errored)
+            self.assertEqual(['goss.json'], list(service.file_results.keys()))
+
+            with open(renders, 'r') as f:
+                return service.total_tests, len(f.read())
+
+        # rendered values with template delimiters are not templated again
+        self.assertEqual((2, 1), run({'/tmp/{{.Names}}': True}))
+        self.assertEqual((2, 1), run({'/tmp/{{.Names}}': True}))
+        self.assertEqual((3, 2), run({'/tmp/{{.Names}}': True, '/var': True}))
+
+        with open(os.path.join(test_dir, 'goss.json'), 'w') as f:
+            f.write(json.dumps({'file': {'/etc': {}, '/usr': {}}}))
+
+        self.assertEqual((4, 3), run({'/tmp/{{.Names}}': True, '/var': True}))
+
+        for name in os.listdir(os.path.join(cache_dir, 'rendered')):
+            self.assertEqual(0o600, stat.S_IMODE(os.stat(os.path.join(cache_dir, 'rendered', name)).st_mode))
+
+    def test_write_private(self):
+        """Tests that concurrent private writes to the same file each replace it whole and leave nothing behind."""
+        directory = self.make_directory()
+        path = os.path.join(directory, 'state.json')
+
+        writers = [threading.Thread(target=self.service.write_private, args=(path, str(i).encode('utf-8') * 4096))
+            for i in range(8)]
+
+        for writer in writers:
+            writer.start()
+
+        for writer in writers:
+            writer.join()
+
+        with open(path, 'rb') as f:
+            self.assertIn(f.read(), [str(i).encode('utf-8') * 4096 for i in range(8)])
+
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(path).st_mode))
+
+        # a failed write removes its staged file
+        with self.assertRaises(TypeError):
+            self.service.write_private(path, None)
+
+        self.assertEqual(['state.json'], os.listdir(directory))
+
+    def test_escape_template(self):
+        """Tests that escaping template delimiters in rendered test files is reversible."""
+        for text in ('{{.Names}}', '{{{', '{{"{{"}}', 'docker ps --format "{{ json . }}"', '{ }}'):
+            self.assertNotIn('{{', escape_template(text).replace(TEMPLATE_ESCAPE, ''))
+            self.assertEqual(text, unescape_template(escape_template(text)))
+
+    def test_baseline(self):
+        """Tests that each run is diffed against the outcome of each check in the previous run."""
+        directory = self.make_directory()
+        state_dir = os.path.join(directory, 'state')
+
+        # a stand-in for goss which fails the checks named in its variables
+        binary_path = os.path.join(directory, 'goss')
+
+        self.write_fake_goss(binary_path, lines=[
+            "variables = json.load(sys.stdin)",
+            "results = [{'resource-type': 'File', 'resource-id': name, 'property': 'exists',",
+            "    'summary-line': name, 'successful': name not in variables['failing']}",
+            "    for name in variables['checks']]",
+            "print(json.dumps({'results': results, 'summary': {'test-count': len(results),",
+            "    'failed-count': len([r for r in results if not r['successful']])}}))",
+        ])
+
+        def run(failing, stream_results=False, checks=('a', 'b', 'c'), test_file='goss.yml'):
+            service = self.make_degoss(tmp_root=tempfile.mkdtemp(dir=directory), test_dir=directory,
+                test_file=[test_file], baseline=True, state_dir=state_dir, stream_results=stream_results)
+            shutil.copy(binary_path, service.executable)
+            service.facts, service.variables = {}, {'checks': list(checks), 'failing': failing}
+            service.test()
+
+            return service.baseline_diff.get_deltas()
+
+        self.assertEqual({'newly_failed': None, 'newly_passed': None, 'unchanged_count': None}, run(['a']))
+        self.assertEqual({'newly_failed': ['b'], 'newly_passed': ['a'], 'unchanged_count': 1}, run(['b']))
+        self.assertEqual({'newly_failed': [], 'newly_passed': [], 'unchanged_count': 3}, run(['b'], True))
+        self.assertEqual({'newly_failed': [], 'newly_passed': ['b'], 'unchanged_count': 2}, run([], True))
+
+        with open(os.path.join(state_dir, 'baseline.json'), 'r') as f:
+            record = json.load(f)
+
+        self.assertEqual([1, 1, 1], list(record['checks'].values()))
+        self.assertEqual(['goss.yml'], record['test_files'])
+
+        # new checks only count when they fail
+        self.assertEqual({'newly_failed': ['e'], 'newly_passed': [], 'unchanged_count': 3},
+            run(['e'], checks='abcde'))
+
+        # the baseline of other test files is not diffed against
+        self.assertEqual({'newly_failed': None, 'newly_passed': None, 'unchanged_count': None},
+            run([], test_file='other.yml'))
+
+    def test_resident(self):
+        """Tests that a resident Goss server is reused until its tests or variables change."""
+        directory = self.make_directory()
+        test_dir, resident_dir = os.path.join(directory, 'tests'), os.path.join(directory, 'resident')
+        os.makedirs(test_dir)
+
+        with open(os.path.join(test_dir, 'goss.yml'), 'w') as f:
+            f.write("file: {}\n")
+
+        # a stand-in for goss serve which fails its check when told to through its variables
+        binary_path = os.path.join(directory, 'goss')
+
+        self.write_fake_goss(binary_path, lines=[
+            "try:\n    from http.server import BaseHTTPRequestHandler, HTTPServer",
+            "except ImportError:\n    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer",
+            "args = sys.argv",
+            "failed = json.load(open(args[args.index('--vars') + 1])).get('fail', False)",
+            "class Handler(BaseHTTPRequestHandler):",
+            "    def do_GET(self):",
+            "        self.send_response(503 if failed else 200)",
+            "        self.end_headers()",
+            "        self.wfile.write(json.dumps({'results': [{'summary-line': 'check', 'successful': not failed}],"
+                " 'summary': {'failed-count': int(failed), 'test-count': 1}}).encode('utf-8'))",
+            "    def log_message(self, *args):\n        pass",
+            "HTTPServer(('127.0.0.1', int(args[args.index('--listen-addr') + 1].split(':')[1])), Handler)"
+                ".serve_forever()",
+        ])
+
+        self.module.params.update(binary_path=binary_path, resident=True, resident_dir=resident_dir,
+            tmp_root=os.path.join(directory, 'tmp'), test_dir=test_dir, test_file=['goss.yml'], version='0.3.6')
+
+        def serve(variables):
+            service = self.make_degoss()
+            service.facts, service.variables = {}, variables
+            service.serve()
+
+            if service.resident_process:
+                self.addCleanup(service.resident_process.wait)
+                self.addCleanup(os.killpg, service.resident_process.pid, signal.SIGKILL)
+
+            return service, service.load_resident_state()
+
+        service, state = serve({})
+
+        self.assertIn('test.start', service.timings)
+        self.assertEqual((1, 0), (service.total_tests, service.failed_tests))
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(resident_dir, 'vars.json')).st_mode), 0o600)
+
+        # the running server is reused
+        service, reused = serve({})
+
+        self.assertEqual(state, reused)
+        self.assertNotIn('test.start', service.timings)
+        self.assertEqual((1, 0), (service.total_tests, service.failed_tests))
+
+        # changed variables restart it
+        service, restarted = serve({'fail': True})
+
+        self.assertNotEqual(state['pid'], restarted['pid'])
+        self.assertEqual((1, 1), (service.total_tests, service.failed_tests))
+        self.assertEqual(['check'], service.failed_messages)
+
+        state_file = os.path.join(resident_dir, 'state.json')
+
+        # a server which stopped responding is restarted rather than failing the run
+        with open(state_file, 'w') as f:
+            json.dump(dict(restarted, port=1), f)
+
+        service, recovered = serve({'fail': True})
+
+        self.assertNotEqual(restarted['pid'], recovered['pid'])
+        self.assertEqual((1, 1), (service.total_tests, service.failed_tests))
+
+        # a recorded pid which now belongs to an unrelated process is neither reused nor stopped
+        with open(state_file, 'w') as f:
+            json.dump(dict(recovered, pid=os.getpid()), f)
+
+        service, replaced = serve({'fail': True})
+
+        self.assertIn('test.start', service.timings)
+        self.assertNotEqual(os.getpid(), replaced['pid'])
+
+    @mock.patch.object(Degoss, 'fail')
+    @mock.patch('library.degoss.subprocess.Popen')
+    def test_run_tests_flags(self, mock_new_popen, mock_fail):
+        """Tests that Goss concurrency and retry flags are passed through."""
+        mock_process = mock.MagicMock()
+        mock_process.communicate.return_value = json.dumps({'summary': {'failed-count': 0, 'test-count': 1}}), None
+        mock_new_popen.return_value = mock_process
+
+        self.service.facts, self.service.variables = {}, {}
+        self.service.max_concurrent, self.service.retry_timeout, self.service.sleep = 4, '30s', '2s'
+
+        with mock.patch("library.degoss.open_result", mock.mock_open()):
+            self.service.test()
+
+        self.assertEqual([self.service.executable, '--gossfile', self.service.test_file, '--vars', '/dev/stdin',
+            'validate', '--no-color', '--format', 'json', '--max-concurrent', '4', '--retry-timeout', '30s',
+            '--sleep', '2s'], mock_new_popen.call_args[0][0])
+
+        mock_fail.assert_not_called()
+
+    @mock.patch.object(Degoss, 'fail')
+    @mock.patch('library.degoss.os.killpg')
+    @mock.patch('library.degoss.subprocess.Popen')
+    def test_run_tests_timeout(self, mock_new_popen, mock_killpg, mock_fail):
+        """Tests that degoss kills the Goss process tree and fails as timed out once the deadline passes."""
+        killed = threading.Event()
+        mock_killpg.side_effect = lambda pid, sig: killed.set()
+
+        def communicate(input=None):
+            # hang until killed
+            self.assertTrue(killed.wait(5))
+            return "", None
+
+        mock_process = mock.MagicMock()
+        mock_process.pid, mock_process.returncode = 4242, -9
+        mock_process.poll.return_value = None
+        mock_process.communicate.side_effect = communicate
+        mock_new_popen.return_value = mock_process
+
+        self.service.facts, self.service.variables = {}, {}
+        self.service.timeout = 0.1
+
+        with mock.patch("library.degoss.open_result", mock.mock_open()):
+            self.service.test()
+
+        self.assertTrue(mock_new_popen.call_args[1]['start_new_session'])
+        mock_killpg.assert_called_with(4242, signal.SIGKILL)
+        mock_fail.assert_called_with("Goss Execution Timed Out (after 0.1s)", timed_out=True,
+            timed_out_files=['dingo.yml'], timeout=0.1)
+
+        self.assertTrue(self.service.errored)
+
+    def test_run_tests_timeout_clean(self):
+        """Tests that a run which timed out still cleans up before the module exits."""
+        directory = self.make_directory()
+        tmp_root, binary_path = os.path.join(directory, 'tmp'), os.path.join(directory, 'goss')
+
+        self.write_fake_goss(binary_path, lines=["import time", "time.sleep(30)"])
+        self.module.exit_json.side_effect = SystemExit
+
+        service = self.make_degoss(binary_path=binary_path, clean=True, clean_on_failure=True, timeout=1,
+            tmp_root=tmp_root, test_dir=os.path.join(tmp_root, 'tests'), test_file=['goss.yml'])
+        service.facts, service.variables = {}, {}
+        os.makedirs(service.test_dir)
+
+        with self.assertRaises(SystemExit):
+            service.execute()
+
+        self.assertEqual(['goss.yml'], service.timed_out_files)
+        self.assertFalse(service.failed)
+        self.assertFalse(os.path.exists(tmp_root))
+
     @mock.patch.object(Degoss, 'errored', new_callable=mock.PropertyMock)
     @mock.patch.object(Degoss, 'failed', new_callable=mock.PropertyMock)
     @mock.patch('library.degoss.os.path.isdir')
@@ -571,6 +1572,10 @@ class DegossTestCase(unittest.TestCase):
         self.service.total_tests = 5
         self.service.test_result = { 'time': 'go' }
 
+        # the timings are logged before cleaning up removes the log file
+        mock_clean.side_effect = lambda: self.assertIn(mock.call("Phase timings: %s", mock.ANY),
+            self.service.logger.info.call_args_list)
+
         self.service.execute()
 
         mock_initialize.assert_called()
@@ -578,15 +1583,25 @@ class DegossTestCase(unittest.TestCase):
         mock_test.assert_called()
         mock_clean.assert_called()
 
+        self.assertEqual(['initialize', 'install', 'test', 'clean'], list(self.service.timings.keys()))
+
         self.module.exit_json.assert_called_with(**{
             'changed': False,
+            'download_bytes': 0,
+            'download_seconds': 0.0,
             'failed': False,
             'failures': self.service.failed_messages,
+            'files': self.service.file_results,
             'msg': "Goss Tests Passed",
+            'result_detail': 'full',
+            'result_file': None,
+            'setup': None,
             'test_result': self.service.test_result,
             'tests_failed': self.service.failed_tests,
             'tests_passed': self.service.total_tests - self.service.failed_tests,
+            'tests_skipped': self.service.skipped_tests,
             'tests_total': self.service.total_tests,
+            'timings': mock.ANY,
         })
         self.module.exit_json.reset_mock()
 
@@ -604,21 +1619,28 @@ class DegossTestCase(unittest.TestCase):
 
         self.module.exit_json.assert_called_with(**{
             'changed': False,
+            'download_bytes': 0,
+            'download_seconds': 0.0,
             'failed': True,
             'failures': self.service.failed_messages,
+            'files': self.service.file_results,
             'msg': "Goss Tests Failed",
+            'result_detail': 'full',
+            'result_file': None,
+            'setup': None,
             'test_result': self.service.test_result,
             'tests_failed': self.service.failed_tests,
             'tests_passed': self.service.total_tests - self.service.failed_tests,
+            'tests_skipped': self.service.skipped_tests,
             'tests_total': self.service.total_tests,
+            'timings': mock.ANY,
         })
 
     @mock.patch.object(Degoss, 'clean')
     def test_fail(self, mock_clean):
         """Tests that fail works as expected."""
         self.module.exit_json = mock.MagicMock()
-        self.service.log_output.write("one\n")
-        self.service.log_output.write("two\n")
+        self.service.log_output.extend(["one", "two"])
 
         self.service.fail("Hello", world=True)
 
@@ -630,10 +1652,289 @@ class DegossTestCase(unittest.TestCase):
             'module_failed': True,
             'msg': "Hello",
             'output_lines': ["one", "two"],
+            'result_file': None,
             'test_count': None,
+            'timings': {},
             'world': True,
         })
 
 
+class DegossCallbackTestCase(unittest.TestCase):
+
+    def setUp(self):
+        """Configure fixtures."""
+        self.display = mock.MagicMock()
+        self.display.verbosity = 0
+        self.callback = DegossCallbackModule(display=self.display)
+
+    def task_result(self, host='dingo', **result):
+        """Create a stub task result for the degoss module."""
+        task_result = mock.MagicMock()
+        task_result._host.get_name.return_value = host
+        task_result._task.action = 'degoss'
+        task_result._result = result
+
+        return task_result
+
+    def run_fleet(self, hosts=100):
+        """Feed results for a fleet of hosts through the callback, every tenth of which fails the same check."""
+        for i in range(hosts):
+            failed = i % 10 == 0
+
+            self.callback.v2_runner_on_failed(self.task_result(host='host{:03d}'.format(i),
+                msg="Goss Tests Failed" if failed else "Goss Tests Passed", tests_total=10,
+                tests_failed=1 if failed else 0, tests_skipped=2,
+                failures=["File: /dev: exists:\nExpected true"] if failed else None,
+                download_bytes=1000, timings={'install.download': 0.5, 'test.goss': (i + 1) / 100.0}))
+
+    def test_summary(self):
+        """Tests that per-host statistics are aggregated into a fleet-wide summary."""
+        self.run_fleet()
+
+        summary = self.callback.summarize()
+
+        self.assertEqual(100, summary['hosts'])
+        self.assertEqual(10, summary['hosts_failed'])
+        self.assertEqual(0, summary['hosts_errored'])
+        self.assertEqual(1000, summary['tests_total'])
+        self.assertEqual(10, summary['tests_failed'])
+        self.assertEqual(200, summary['tests_skipped'])
+        self.assertEqual(100000, summary['download_bytes'])
+        self.assertEqual({'p50': 0.5, 'p95': 0.95, 'p99': 0.99}, summary['goss_seconds'])
+        self.assertEqual({'p50': 0.5, 'p95': 0.5, 'p99': 0.5}, summary['download_seconds'])
+        self.assertEqual(['host099', 'host098'], [entry['host'] for entry in summary['slowest_hosts'][:2]])
+        self.assertEqual([{'failure': "File: /dev: exists:\nExpected true", 'hosts': 10}], summary['common_failures'])
+
+        self.display.reset_mock()
+        self.callback.v2_playbook_on_stats(mock.MagicMock())
+
+        output = self.display.display.call_args[0][0]
+
+        self.assertIn("Degoss Summary: 100 host(s), 10 failed, 0 errored; 1000 test(s), 10 failed, 200 skipped", output)
+        self.assertIn("p50 0.500s, p95 0.950s, p99 0.990s", output)
+        self.assertIn("10 host(s): File: /dev: exists:", output)
+
+    def test_rollup(self):
+        """Tests that identical failures across hosts are printed once, normalized for host-specific values."""
+        self.callback.rollup = True
+
+        for i in range(50):
+            host = 'web{:02d}.example.com'.format(i)
+
+            self.callback.v2_runner_on_failed(self.task_result(host=host, msg="Goss Tests Failed", tests_total=2,
+                tests_failed=2, failures=[
+                    "Command: hostname: stdout:\nExpected\n    web{:02d}\nto contain web".format(i),
+                    "Addr: tcp://10.0.0.{}:443: reachable:\nExpected true".format(i),
+                ]))
+
+            output = self.display.display.call_args[0][0]
+
+            self.assertNotIn("Expected", output)
+            self.assertIn("(2 failure(s) rolled up into the summary)", output)
+
+        self.display.reset_mock()
+        self.callback.v2_playbook_on_stats(mock.MagicMock())
+
+        output = self.display.display.call_args_list[0][0][0]
+
+        self.assertIn("Degoss Failures: 2 distinct failure(s)", output)
+        self.assertEqual(2, output.count("50 host(s): web00.example.com, web01.example.com"))
+        self.assertIn("and 30 more", output)
+        self.assertIn("  Addr: tcp://<ip>:443: reachable:", output)
+        self.assertIn("      <host>", output)
+
+        summary = self.callback.summarize()
+
+        self.assertEqual([
+            {'failure': "Addr: tcp://<ip>:443: reachable:\nExpected true", 'hosts': 50},
+            {'failure': "Command: hostname: stdout:\nExpected\n    <host>\nto contain web", 'hosts': 50},
+        ], summary['common_failures'])
+
+    def test_summary_file(self):
+        """Tests that the summary can be written as JSON or per host as CSV."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        self.run_fleet(hosts=3)
+
+        self.callback.summary_file = os.path.join(directory, 'summary.json')
+        self.callback.v2_playbook_on_stats(mock.MagicMock())
+
+        with open(self.callback.summary_file, 'r') as f:
+            self.assertEqual(3, json.load(f)['hosts'])
+
+        self.callback.summary_file = os.path.join(directory, 'summary.csv')
+        self.callback.v2_playbook_on_stats(mock.MagicMock())
+
+        with open(self.callback.summary_file, 'r') as f:
+            rows = list(csv.DictReader(f))
+
+        self.assertEqual(['host000', 'host001', 'host002'], [row['host'] for row in rows])
+        self.assertEqual('0.02', rows[1]['goss_seconds'])
+
+    def test_pretty_print_summary_detail(self):
+        """Tests that failures which were not returned are pointed to on the host."""
+        self.callback.v2_runner_on_failed(self.task_result(msg="Goss Tests Failed", tests_total=2, tests_failed=1,
+            failures=None, result_file='/tmp/degoss.abc/result.json'))
+
+        output = self.display.display.call_args[0][0]
+
+        self.assertIn("(1 failure(s) not returned, see /tmp/degoss.abc/result.json on the host)", output)
+
+    def test_pretty_print_deltas(self):
+        """Tests that only the changes since the previous run are printed when asked to."""
+        self.callback.deltas_only = True
+        self.callback.v2_runner_on_failed(self.task_result(msg="Goss Tests Failed", tests_total=3, tests_failed=2,
+            failures=["old failure", "new failure"], newly_failed=["new failure"], newly_passed=["fixed"],
+            unchanged_count=1))
+
+        output = self.display.display.call_args[0][0]
+
+        self.assertIn("(1 newly failed, 1 newly passed, 1 unchanged)", output)
+        self.assertIn("Newly failed:" + os.linesep + "new failure", output)
+        self.assertIn("Newly passed:" + os.linesep + "fixed", output)
+        self.assertNotIn("old failure", output)
+
+    def test_pretty_print_module_failure(self):
+        """Tests that module failures which did not come from Goss output are printed and still reported."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        self.callback.ndjson_file = os.path.join(directory, 'results.ndjson')
+        self.callback.v2_runner_on_failed(self.task_result(msg="Goss Execution Timed Out (after 5s)", failed=True,
+            module_failed=True, timed_out=True, timeout=5, output_lines=["[ERROR] Goss did not finish within 5s"]))
+
+        output = self.display.display.call_args[0][0]
+
+        self.assertIn("Goss Execution Timed Out (after 5s)", output)
+        self.assertIn("  [ERROR] Goss did not finish within 5s", output)
+        self.assertEqual(1, self.callback.summarize()['hosts_errored'])
+
+        self.callback.close_reports()
+
+        with open(self.callback.ndjson_file, 'r') as f:
+            self.assertTrue(json.loads(f.readline())['module_failed'])
+
+        # neither output is returned at all
+        self.callback.v2_runner_on_failed(self.task_result(msg="Refusing to request it in offline mode",
+            module_failed=True))
+
+        self.assertIn("Refusing to request it in offline mode", self.display.display.call_args[0][0])
+
+    def test_report_files(self):
+        """Tests that NDJSON and JUnit XML reports are written as results arrive."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        self.callback.ndjson_file = os.path.join(directory, 'results.ndjson')
+        self.callback.junit_file = os.path.join(directory, 'results.xml')
+
+        self.callback.v2_runner_on_ok(self.task_result(host='dingo', msg="Goss Tests Passed", tests_total=2,
+            tests_failed=1, failures=["Command: hostname: stdout:"], timings={'test.goss': 1.5}, test_result={'results': [
+                {'resource-type': 'File', 'resource-id': '/dev', 'property': 'exists', 'successful': True,
+                    'duration': 1000000},
+                {'resource-type': 'Command', 'resource-id': 'hostname', 'property': 'stdout', 'successful': False,
+                    'summary-line': "Command: hostname: stdout:\nExpected <\x1bdingo>", 'duration': 2000000},
+            ]}))
+
+        # the host's line is available before the play completes
+        with open(self.callback.ndjson_file, 'r') as f:
+            self.assertEqual('dingo', json.loads(f.readline())['host'])
+
+        self.callback.v2_runner_on_failed(self.task_result(host='dog & pony', msg="Goss Tests Failed",
+            tests_total=3, tests_failed=1, failures=["File: /etc: exists:\nExpected true"]))
+        self.callback.v2_runner_on_failed(self.task_result(host='error', msg="Unable to download Goss",
+            module_failed=True, stdout_lines=["HTTP 404"]))
+        self.callback.v2_playbook_on_stats(mock.MagicMock())
+
+        with open(self.callback.ndjson_file, 'r') as f:
+            records = [json.loads(line) for line in f]
+
+        self.assertEqual(['dingo', 'dog & pony', 'error'], [record['host'] for record in records])
+        self.assertEqual(1, records[1]['tests_failed'])
+        self.assertTrue(records[2]['module_failed'])
+
+        suites = ElementTree.parse(self.callback.junit_file).getroot().findall('testsuite')
+
+        self.assertEqual(['dingo', 'dog & pony', 'error'], [suite.get('name') for suite in suites])
+        self.assertEqual(('2', '1', '1.500'), (suites[0].get('tests'), suites[0].get('failures'),
+            suites[0].get('time')))
+        self.assertEqual(['/dev: exists', 'hostname: stdout'],
+            [case.get('name') for case in suites[0].findall('testcase')])
+        self.assertEqual("Command: hostname: stdout:\nExpected <dingo>",
+            suites[0].findall('testcase')[1].find('failure').text)
+        self.assertEqual("File: /etc: exists:", suites[1].find('testcase/failure').get('message'))
+        self.assertEqual('1', suites[2].get('errors'))
+        self.assertEqual("Unable to download Goss", suites[2].find('testcase/error').get('message'))
+
+    def test_pretty_print_timings(self):
+        """Tests that phase timings are printed as a footer."""
+        self.callback.v2_runner_on_ok(self.task_result(msg="Goss Tests Passed", tests_total=2, tests_failed=0,
+            timings={'initialize': 0.01, 'install.download': 1.2, 'install.verify': 0.05, 'install': 1.3,
+                'test.goss': 2.0, 'test': 2.1, 'clean': 0.02}))
+
+        output = self.display.display.call_args[0][0]
+
+        self.assertIn("(Count: 2, Failed: 0, Skipped: 0)", output)
+        self.assertIn("(Timings: initialize 0.010s, install 1.300s (download: 1.200s, verify: 0.050s), "
+            "test 2.100s (goss: 2.000s), clean 0.020s)", output)
+
+
+class DegossFiltersTestCase(unittest.TestCase):
+
+    def setUp(self):
+        """Configure fixtures."""
+        self.base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.base_dir)
+
+        os.makedirs(os.path.join(self.base_dir, 'more'))
+
+        self.write('goss.yml', 'command:\n  hostname:\n    stdout: [{{.Vars.ansible_hostname}}]\n')
+        self.write('more/mounts.yml', '{{ range $.Vars.ansible_mounts }}{{ .mount }}{{ end }}\n'
+            '{{ index .Vars "ansible_os_family" }} {{ .Vars.custom.nested }}\n')
+
+    def write(self, name, content):
+        with open(os.path.join(self.base_dir, name), 'w') as f:
+            f.write(content)
+
+    def test_referenced_vars(self):
+        """Tests that variable references are found in test files and directories."""
+        self.assertEqual(['ansible_hostname'], referenced_vars(['goss.yml'], self.base_dir))
+        self.assertEqual(['ansible_hostname', 'ansible_mounts', 'ansible_os_family', 'custom'],
+            referenced_vars(['goss.yml', 'more'], self.base_dir))
+
+        # using .Vars as a whole may reference anything
+        self.write('more/all.yml', '{{ range $key, $value := .Vars }}{{ $key }}{{ end }}\n')
+        self.assertIsNone(referenced_vars(['goss.yml', os.path.join(self.base_dir, 'more')], self.base_dir))
+
+    def test_tree_hash(self):
+        """Tests that the hash of the test tree only changes when the deployed names or contents change."""
+        digest = tree_hash(['goss.yml', 'more'], self.base_dir)
+
+        self.assertEqual(digest, tree_hash(['goss.yml', os.path.join(self.base_dir, 'more')], self.base_dir))
+        self.assertNotEqual(digest, tree_hash(['goss.yml', 'more/'], self.base_dir))
+        self.assertNotEqual(digest, tree_hash(['more', 'goss.yml'], self.base_dir))
+
+        self.write('more/mounts.yml', 'file: {}\n')
+        self.assertNotEqual(digest, tree_hash(['goss.yml', 'more'], self.base_dir))
+
+        changed = tree_hash(['goss.yml', 'more'], self.base_dir)
+        os.rename(os.path.join(self.base_dir, 'more/mounts.yml'), os.path.join(self.base_dir, 'more/other.yml'))
+        self.assertNotEqual(changed, tree_hash(['goss.yml', 'more'], self.base_dir))
+
+    def test_bundle_entries(self):
+        """Tests that directories are archived as themselves, or as their contents with a trailing slash."""
+        expected = [(self.base_dir, 'goss.yml'), (self.base_dir, 'more'), (os.path.join(self.base_dir, 'more/'), '.')]
+        self.assertEqual(expected, bundle_entries(['goss.yml', 'more', 'more/'], self.base_dir))
+
+    def test_select_facts(self):
+        """Tests that only referenced and allowed facts are selected."""
+        facts = {'hostname': 'dingo', 'mounts': [], 'os_family': 'Debian', 'interfaces': ['lo']}
+
+        self.assertEqual({'hostname': 'dingo', 'os_family': 'Debian'},
+            select_facts(facts, ['ansible_hostname', 'custom'], ['os_family']))
+        self.assertEqual(facts, select_facts(facts, None))
+
+
 if __name__ == "__main__":
     unittest.main()